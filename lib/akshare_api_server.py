@@ -1,313 +1,2481 @@
-import akshare as ak
-import pandas as pd
 import sqlite3
+import importlib
+import importlib.util
 import os
-from fastapi import FastAPI, HTTPException, Query
+import bisect
+import time
+import asyncio
+import functools
+import json
+import gzip
+import hashlib
+import sys
+from collections import deque, OrderedDict, Counter
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from fastapi import FastAPI, HTTPException, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
-import uvicorn
-from datetime import datetime, timedelta
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse
+from datetime import datetime, timedelta, time as dtime
 import logging
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Callable, Any, Iterable, Tuple
 import threading
+try:
+    import brotli  # 可选依赖：安装后对支持 br 的客户端优先使用 brotli 压缩
+except ImportError:
+    brotli = None
+try:
+    import fcntl  # Windows 无 fcntl，多进程选主退化为“当前进程即 leader”
+except ImportError:
+    fcntl = None
+
+
+class LazyModule:
+    """首次访问属性时才导入的模块代理：akshare / pandas 导入需要数秒，不应阻塞服务启动"""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    started = time.perf_counter()
+                    self._module = importlib.import_module(self._name)
+                    logging.getLogger(__name__).info(
+                        f"已导入 {self._name}，耗时 {time.perf_counter() - started:.2f}s")
+        return self._module
+
+    def __getattr__(self, attr: str):
+        return getattr(self.load(), attr)
+
+ak = LazyModule("akshare")
+pd = LazyModule("pandas")
+np = LazyModule("numpy")
+pa = LazyModule("pyarrow")
+pq = LazyModule("pyarrow.parquet")
+pc = LazyModule("pyarrow.compute")
+
 lock = threading.Lock()
 # 数据库配置
 DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stock_data.db")
 DATA_RETENTION_DAYS = 180  # 数据保留180天（约半年）
+MARKET_OPEN_TIME = dtime(9, 30)  # A股开盘时间
+MARKET_CLOSE_TIME = dtime(15, 0)  # A股收盘时间
+INDEX_SYNC_MIN_INTERVAL = 300  # 同一指数两次增量同步的最小间隔（秒），避免盘中反复请求上游
+INDUSTRY_PRELOAD_DAYS = 30  # 行业数据补齐窗口（天），历史行业数据获取较慢
+CALENDAR_RETRY_BASE = 5.0    # 交易日历上游拉取失败后的首次重试间隔（秒），每次失败翻倍
+CALENDAR_RETRY_MAX = 300.0   # 交易日历重试间隔上限（秒）
+
+# 分析指标配置：滚动收益率/波动率的窗口（交易日）
+ANALYTICS_PERIODS = (5, 20, 60)
+ANALYTICS_TOP_MAX = 100  # /api/industry/top 单次最多返回的行业数
+ANALYTICS_DEBOUNCE_SECONDS = 2.0  # 数据写入后等待合并的时间（流式分批入库、多指数并发补齐只重算一次）
+ANALYTICS_POLL_SECONDS = 30       # 检查其他 worker 写入的待重算标记的间隔（秒）
+
+# 列式归档配置：超出保留期的数据按月压缩为 Parquet 文件（需安装可选依赖 pyarrow，未安装时直接删除）
+ARCHIVE_ENABLED = importlib.util.find_spec("pyarrow") is not None
+ARCHIVE_COMPRESSION = "zstd"
+ARCHIVE_TABLE_CACHE_SIZE = 24  # 内存中保留的已打开月份文件数
+
+# 定时刷新配置
+REFRESH_DELAY_AFTER_CLOSE = timedelta(minutes=30)  # 收盘后延迟刷新，等待上游数据落地
+# 当日数据定型的时刻（收盘 + 延迟）：早于该时刻写入的当日数据是盘中快照，收盘后刷新时需重新拉取覆盖
+SETTLE_CLOCK = (datetime.combine(datetime.min, MARKET_CLOSE_TIME) + REFRESH_DELAY_AFTER_CLOSE).strftime("%H:%M:%S")
+SCHEDULER_POLL_SECONDS = 60  # 调度线程检查间隔（秒）
+
+# 上游并发抓取配置
+FETCH_MAX_WORKERS = 8        # 同时在途的上游请求数
+FETCH_RATE_PER_SEC = 5.0     # 令牌桶速率（每秒请求数），避免被上游封禁
+FETCH_BURST = 8              # 令牌桶容量（允许的突发请求数）
+FETCH_TASK_TIMEOUT = 20.0    # 单次请求超时（秒）
+FETCH_MAX_RETRIES = 2        # 单个任务失败后的重试次数
+INDUSTRY_STREAM_SAVE_BATCH = 20  # 流式拉取行业数据时每累计多少条记录入库一次
+
+# 上游熔断配置：连续失败达到阈值后熔断，冷却期按指数退避，冷却结束后放行单个探测请求
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_BASE_COOLDOWN = 15.0   # 首次熔断冷却时间（秒）
+BREAKER_MAX_COOLDOWN = 600.0   # 冷却时间上限（秒）
+
+# 当日数据的新鲜度（秒）：超过后先返回旧快照（stale），并在后台刷新
+FRESHNESS_TTL = {
+    "index": 60,
+    "industry": 300,
+}
+
+# 阻塞任务执行器配置（异步端点中的 akshare / SQLite 调用都放到独立线程池执行）
+UPSTREAM_EXECUTOR_WORKERS = 4  # 上游拉取任务（每个任务内部还会再并发扇出）
+DB_EXECUTOR_WORKERS = 8        # SQLite 读写任务
+
+# HTTP 缓存配置
+HTTP_CACHE_PATH_PREFIX = "/api/"      # 预热完成建表前到达的请求需等待的接口前缀
+HISTORICAL_CACHE_MAX_AGE = 86400      # 已收盘交易日的数据不再变化，客户端可长时间缓存（秒）
+COMPRESS_MIN_BYTES = 1024             # 小于该大小的响应不压缩
+HOT_CACHE_MAX_BYTES = 64 * 1024 * 1024  # 进程内热数据层的内存预算（响应体及其压缩版本的总字节数）
+# 降级响应（上游部分失败、只返回了部分数据）的 Cache-Control：客户端与服务端缓存都不保存，下次请求重新补齐
+DEGRADED_CACHE_CONTROL = "no-store"
+
+# 启动预热配置
+WARMUP_SCHEMA_WAIT = 30.0  # 预热完成建表前到达的数据请求最多等待的秒数
+
+# 多进程部署配置（API_WORKERS > 1 时以 uvicorn 多 worker 启动）
+API_WORKERS = int(os.environ.get("API_WORKERS", "1"))
+LEADER_RETRY_SECONDS = 30       # 非 leader 进程尝试接管的间隔（秒）
+WRITE_LOCK_RETRIES = 3          # 数据库被其他进程写锁占用（超过 busy_timeout）后的重试次数
+WRITE_RETRY_BACKOFF = 0.5       # 写锁重试的初始退避（秒），每次翻倍
+REGISTRY_RELOAD_SECONDS = 30    # 指数注册表内存缓存的重新加载间隔（其他进程可能已修改）
+# 数据接口：只有这些接口的 GET 响应带 ETag / Cache-Control，并进入热数据层与跨进程共享的响应缓存
+# （调度状态、代码注册表等控制面接口不缓存）
+HTTP_CACHE_PATHS = {"/api/index", "/api/industry", "/api/index/range", "/api/industry/range", "/api/market/summary"}
+
+# 指标配置
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+EVENT_LOOP_LAG_INTERVAL = 0.5   # 事件循环延迟探测间隔（秒）
+PROFILING_ENABLED = os.environ.get("API_PROFILING") == "1"  # 允许请求带 _profile=1 开启采样分析
+PROFILE_SAMPLE_INTERVAL = 0.005  # 采样间隔（秒）
+PROFILE_HISTORY = 20             # 保留最近多少次采样结果
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+app = FastAPI(
+    title="AkShare API服务",
+    description="为Flutter应用提供股票数据API",
+    version="1.0.0"
+)
+
+# 全局异常处理
+@app.exception_handler(Exception)
+async def global_exception_handler(request, exc):
+    logger.error(f"全局异常处理: {exc}")
+    return {"code": 500, "message": f"服务器错误: {str(exc)}", "data": []}
+
+# 请求日志中间件
+@app.middleware("http")
+async def log_requests(request, call_next):
+    start_time = datetime.now()
+    response = await call_next(request)
+    process_time = (datetime.now() - start_time).total_seconds()
+    logger.info(f"{request.method} {request.url.path} - 处理时间: {process_time:.3f}s")
+    return response
+
+# ==================== HTTP 缓存 ====================
+def _reference_date(request) -> Optional[str]:
+    """响应数据对应的（最晚）日期 YYYY-MM-DD；未指定日期（即当日）时返回 None"""
+    params = request.query_params
+    try:
+        if request.url.path.endswith("/range"):
+            value = params.get("end")
+            return datetime.strptime(value, "%Y%m%d").strftime("%Y-%m-%d") if value else None
+        if request.url.path == "/api/market/summary":
+            if params.get("month"):
+                first = datetime.strptime(params["month"], "%Y%m")
+                return ((first + timedelta(days=32)).replace(day=1) - timedelta(days=1)).strftime("%Y-%m-%d")
+            if params.get("year"):
+                return f"{int(params['year']):04d}-12-31"
+            return None
+        value = params.get("date")
+        return datetime.strptime(value, "%Y%m%d").strftime("%Y-%m-%d") if value else None
+    except ValueError:
+        return None
+
+def _body_data_source(body: bytes) -> Optional[str]:
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        return None
+    return payload.get("data_source") if isinstance(payload, dict) else None
+
+def cache_max_age(request, body: bytes) -> int:
+    """已定型交易日（收盘 + 刷新延迟之后）的数据长期缓存，其余按新鲜度短期缓存
+
+    即使日期已定型，旧快照（stale）与当日实时拉取（live）的响应也只短期缓存：
+    前者是前一交易日的数据，后者可能早于上游数据最终落地。
+    """
+    ref = _reference_date(request)
+    settled = last_settled_trading_day()
+    if ref and settled and ref <= settled:
+        source = _body_data_source(body)
+        if source != "stale" and not (source == "live" and ref >= datetime.now().strftime("%Y-%m-%d")):
+            return HISTORICAL_CACHE_MAX_AGE
+    return FRESHNESS_TTL["industry" if "industry" in request.url.path else "index"]
+
+def shared_cache_key(request) -> str:
+    """共享响应缓存的 key（路径 + 排序后的查询参数）"""
+    query = "&".join(f"{k}={v}" for k, v in sorted(request.query_params.multi_items()))
+    return f"{request.url.path}?{query}"
+
+def _choose_encoding(accept_encoding: str) -> Optional[str]:
+    accepted = {part.split(";")[0].strip().lower() for part in accept_encoding.split(",")}
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+def _etag_matches(if_none_match: str, digest: str) -> bool:
+    """If-None-Match 使用弱比较：忽略 W/ 前缀和编码后缀"""
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if tag.removeprefix("W/").strip('"').split("-")[0] == digest:
+            return True
+    return False
+
+class HotCache:
+    """进程内热数据层：缓存序列化后的响应体（及其 ETag、压缩版本），位于共享 SQLite 缓存之前
+
+    key 为接口路径 + 查询参数（即数据集、代码、日期）；按内存预算做 LRU 淘汰。
+    当日数据按新鲜度短 TTL，已收盘交易日不过期，数据写入时按日期失效。
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        # key -> [响应体, 摘要, 数据日期, 过期时间(None 为不过期), 编码 -> 压缩后的响应体, Cache-Control 时长]
+        self._entries: "OrderedDict[str, list]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.generation = 0  # 每次失效加一：生成期间发生过失效的响应体不再写入
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size(entry: list) -> int:
+        return len(entry[0]) + sum(len(v) for v in entry[4].values())
+
+    def _drop(self, key: str):
+        self._bytes -= self._size(self._entries.pop(key))
+
+    def get(self, key: str) -> Optional[list]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[3] is not None and entry[3] <= time.monotonic():
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, body: bytes, digest: str, ref_date: Optional[str], max_age: int, ttl: Optional[float],
+            generation: int) -> Optional[list]:
+        entry = [body, digest, ref_date, None if ttl is None else time.monotonic() + ttl, {}, max_age]
+        with self._lock:
+            if generation != self.generation:
+                return None
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = entry
+            self._bytes += len(body)
+            self._evict()
+        return entry
+
+    def add_encoded(self, key: str, entry: list, encoding: str, encoded: bytes):
+        """记录压缩后的版本，后续命中直接复用"""
+        with self._lock:
+            if self._entries.get(key) is entry and encoding not in entry[4]:
+                entry[4][encoding] = encoded
+                self._bytes += len(encoded)
+                self._evict()
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def invalidate(self, dates: Iterable[str]):
+        """删除当日响应和数据日期不早于最早写入日期的响应"""
+        earliest = min(dates, default=None)
+        if earliest is None:
+            return
+        with self._lock:
+            self.generation += 1
+            for key in [k for k, e in self._entries.items() if e[2] is None or e[2] >= earliest]:
+                self._drop(key)
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else None,
+            "evictions": self.evictions,
+        }
+
+hot_cache = HotCache(HOT_CACHE_MAX_BYTES)
+
+def hot_cache_ttl(max_age: int) -> Optional[float]:
+    """已定型交易日不过期；多 worker 时其他进程的写入无法通知本进程，改用 HTTP 缓存时长兜底"""
+    if max_age == HISTORICAL_CACHE_MAX_AGE and API_WORKERS == 1:
+        return None
+    return max_age
+
+# 热数据层 + 共享响应缓存 + ETag（基于响应内容的强校验值）+ 304 + Cache-Control + gzip/brotli 压缩
+@app.middleware("http")
+async def http_cache(request, call_next):
+    if request.url.path.startswith(HTTP_CACHE_PATH_PREFIX):
+        try:
+            await wait_for_schema()
+        except HTTPException as e:
+            return JSONResponse(status_code=e.status_code, content={"detail": e.detail})
+    if request.method != "GET" or request.url.path not in HTTP_CACHE_PATHS:
+        return await call_next(request)
+
+    key = shared_cache_key(request)
+    passthrough = {"content-type": "application/json"}
+    entry = hot_cache.get(key)
+    generation = hot_cache.generation
+    if entry is None:
+        # 任一 worker 生成过且未失效的响应体直接复用，不再进入接口
+        body = await run_db(get_shared_response, key)
+        record_cache_lookup("response_cache", int(body is not None), int(body is None))
+        generated = body is None
+        if generated:
+            response = await call_next(request)
+            # 接口自行设置了 Cache-Control（降级响应）时原样返回，不进入任何缓存层
+            if (response.status_code != 200
+                    or not response.headers.get("content-type", "").startswith("application/json")
+                    or "cache-control" in response.headers):
+                return response
+            body = b"".join([chunk async for chunk in response.body_iterator])
+            passthrough = {k: v for k, v in response.headers.items() if k.lower() not in ("content-length", "content-encoding")}
+        # 计算缓存时长要查交易日历（可能等待预热线程向上游拉取日历），不能阻塞事件循环
+        max_age = await run_db(cache_max_age, request, body)
+        if generated:
+            asyncio.ensure_future(run_db(
+                put_shared_response, key, body, _reference_date(request), max_age
+            )).add_done_callback(_log_background_result)
+        digest = hashlib.sha1(body).hexdigest()
+        entry = hot_cache.put(key, body, digest, _reference_date(request), max_age, hot_cache_ttl(max_age), generation)
+    else:
+        body, digest, max_age = entry[0], entry[1], entry[5]
+
+    encoding = _choose_encoding(request.headers.get("accept-encoding", "")) if len(body) >= COMPRESS_MIN_BYTES else None
+    headers = {
+        "ETag": f'"{digest}-{encoding}"' if encoding else f'"{digest}"',
+        "Cache-Control": f"public, max-age={max_age}",
+        "Vary": "Accept-Encoding",
+    }
+
+    if _etag_matches(request.headers.get("if-none-match", ""), digest):
+        return Response(status_code=304, headers=headers)
+
+    if encoding:
+        encoded = entry[4].get(encoding) if entry is not None else None
+        if encoded is None:
+            encoded = brotli.compress(body, quality=5) if encoding == "br" else gzip.compress(body, compresslevel=6)
+            if entry is not None:
+                hot_cache.add_encoded(key, entry, encoding, encoded)
+        body = encoded
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, status_code=200, headers={**passthrough, **headers})
+
+# ==================== 指标 ====================
+class MetricsRegistry:
+    """进程内指标（Prometheus 文本格式输出）；多 worker 部署时每个进程各自统计"""
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self._meta: Dict[str, Tuple[str, str]] = {}  # 指标名 -> (类型, 说明)
+        self._values: Dict[str, Dict[Tuple, Any]] = {}
+        self._collectors: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    def _series(self, kind: str, name: str, help_text: str, labels: Dict[str, str], default: Callable):
+        self._meta.setdefault(name, (kind, help_text))
+        series = self._values.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        if key not in series:
+            series[key] = default()
+        return series, key
+
+    def inc(self, name: str, help_text: str, value: float = 1, **labels):
+        with self._lock:
+            series, key = self._series("counter", name, help_text, labels, float)
+            series[key] += value
+
+    def set(self, name: str, help_text: str, value: float, **labels):
+        with self._lock:
+            series, key = self._series("gauge", name, help_text, labels, float)
+            series[key] = value
+
+    def observe(self, name: str, help_text: str, value: float, **labels):
+        with self._lock:
+            series, key = self._series("histogram", name, help_text, labels,
+                                       lambda: [0] * len(self.buckets) + [0.0, 0])
+            hist = series[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist[i] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    def add_collector(self, fn: Callable[[], None]):
+        """注册渲染前调用的采集函数（把其他组件的统计转成 gauge）"""
+        self._collectors.append(fn)
+
+    @staticmethod
+    def _labels(key: Tuple, le: Optional[str] = None) -> str:
+        pairs = list(key) + ([("le", le)] if le is not None else [])
+        parts = []
+        for k, v in pairs:
+            escaped = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            parts.append(f'{k}="{escaped}"')
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        for fn in self._collectors:
+            try:
+                fn()
+            except Exception as e:
+                logger.warning(f"指标采集失败: {e}")
+        lines = []
+        with self._lock:
+            for name, series in self._values.items():
+                kind, help_text = self._meta[name]
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in series.items():
+                    if kind != "histogram":
+                        lines.append(f"{name}{self._labels(key)} {value}")
+                        continue
+                    for bound, count in zip(self.buckets, value):
+                        lines.append(f"{name}_bucket{self._labels(key, str(bound))} {count}")
+                    lines.append(f"{name}_bucket{self._labels(key, '+Inf')} {value[-1]}")
+                    lines.append(f"{name}_sum{self._labels(key)} {value[-2]}")
+                    lines.append(f"{name}_count{self._labels(key)} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry(METRICS_LATENCY_BUCKETS)
+
+def record_cache_lookup(table: str, hits: int, misses: int):
+    if hits:
+        metrics.inc("cache_lookups_total", "缓存查询次数（按表和命中情况）", hits, table=table, result="hit")
+    if misses:
+        metrics.inc("cache_lookups_total", "缓存查询次数（按表和命中情况）", misses, table=table, result="miss")
+
+async def monitor_event_loop_lag():
+    """定期 sleep 并测量实际唤醒延迟：阻塞事件循环的代码会直接体现在这里"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        lag = max(0.0, loop.time() - started - EVENT_LOOP_LAG_INTERVAL)
+        metrics.set("event_loop_lag_seconds", "最近一次事件循环唤醒延迟（秒）", lag)
+        metrics.observe("event_loop_lag_seconds_hist", "事件循环唤醒延迟分布（秒）", lag)
+
+class SamplingProfiler:
+    """请求级采样分析：请求处理期间定时抓取全进程活跃线程的调用栈
+
+    只统计栈上有本模块代码的线程（空闲的线程池线程和事件循环不计入），
+    按“本模块最内层函数 -> 最内层调用”聚合，看出慢请求主要耗在哪次上游调用或数据库步骤。
+    采样期间其他并发请求的工作也会被计入。
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self.total = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                leaf = f"{frame.f_code.co_filename.rsplit(os.sep, 1)[-1]}:{frame.f_code.co_name}"
+                while frame is not None and frame.f_code.co_filename != __file__:
+                    frame = frame.f_back
+                if frame is None:
+                    continue
+                self.samples[f"{frame.f_code.co_name}:{frame.f_lineno} -> {leaf}"] += 1
+                self.total += 1
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def report(self, top: int = 15) -> List[Dict]:
+        return [{"stack": stack, "samples": n, "ratio": round(n / self.total, 3)}
+                for stack, n in self.samples.most_common(top)]
+
+recent_profiles: deque = deque(maxlen=PROFILE_HISTORY)
+
+# 请求延迟指标 + 可选采样分析（CORS 之内的最外层中间件，缓存命中的请求也计入）
+@app.middleware("http")
+async def collect_metrics(request, call_next):
+    profiler = None
+    if PROFILING_ENABLED and request.query_params.get("_profile") == "1":
+        profiler = SamplingProfiler(PROFILE_SAMPLE_INTERVAL).__enter__()
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        elapsed = time.perf_counter() - started
+        route = request.scope.get("route")
+        path = route.path if route is not None else (
+            request.url.path if request.url.path in HTTP_CACHE_PATHS else "unmatched")
+        metrics.observe("http_request_duration_seconds", "接口处理耗时（秒）", elapsed,
+                        method=request.method, path=path)
+        metrics.inc("http_requests_total", "接口请求数", method=request.method, path=path, status=str(status))
+        if profiler is not None:
+            await asyncio.get_running_loop().run_in_executor(None, profiler.__exit__)
+            recent_profiles.append({
+                "path": str(request.url.path), "query": str(request.url.query),
+                "elapsed": round(elapsed, 3), "samples": profiler.total, "top": profiler.report()
+            })
+            logger.info(f"采样分析 {request.url.path}: {profiler.report(3)}")
+
+# 配置CORS中间件，允许Flutter应用访问
+# 最后注册即为最外层：缓存中间件直接返回的 304 与缓存命中响应同样带上 CORS 响应头
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],  # 在生产环境中应该设置具体的域名
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+# ==================== 存储层 ====================
+# WAL 模式下读写互不阻塞：每个线程持有一个只读连接，所有写入经由唯一的写连接串行提交
+_thread_local = threading.local()
+_writer_conn: Optional[sqlite3.Connection] = None
+
+def _configure_connection(conn: sqlite3.Connection):
+    """连接级 pragma 调优"""
+    conn.execute("PRAGMA synchronous=NORMAL")     # WAL 下安全且显著减少 fsync
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA cache_size=-16000")      # 约16MB页缓存
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")    # 256MB 内存映射读
+
+def get_read_conn() -> sqlite3.Connection:
+    """获取当前线程的只读连接（按线程复用，语句缓存随连接保留）"""
+    conn = getattr(_thread_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, cached_statements=256)
+        _configure_connection(conn)
+        conn.execute("PRAGMA query_only=1")
+        _thread_local.conn = conn
+    return conn
+
+def _get_writer_conn() -> sqlite3.Connection:
+    """获取唯一的写连接（调用方需持有 lock）"""
+    global _writer_conn
+    if _writer_conn is None:
+        _writer_conn = sqlite3.connect(DB_PATH, cached_statements=256, check_same_thread=False)
+        _writer_conn.execute("PRAGMA journal_mode=WAL")
+        _configure_connection(_writer_conn)
+    return _writer_conn
+
+def _is_lock_error(e: sqlite3.OperationalError) -> bool:
+    message = str(e)
+    return "locked" in message or "busy" in message
+
+@contextmanager
+def write_transaction():
+    """写事务：进程内由 lock 串行，跨进程由 BEGIN IMMEDIATE 预先获取写锁
+
+    其他 worker 持有写锁时先由 busy_timeout 等待，超时后再按指数退避重试；
+    成功提交，异常回滚。
+    """
+    with lock:
+        conn = _get_writer_conn()
+        backoff = WRITE_RETRY_BACKOFF
+        for attempt in range(WRITE_LOCK_RETRIES + 1):
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                break
+            except sqlite3.OperationalError as e:
+                if not _is_lock_error(e) or attempt == WRITE_LOCK_RETRIES:
+                    raise
+                logger.warning(f"数据库写锁被占用，{backoff:.1f}s 后重试（第{attempt + 1}次）")
+                time.sleep(backoff)
+                backoff *= 2
+        started = time.perf_counter()
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            metrics.observe("sqlite_write_duration_seconds", "写事务耗时（秒，不含等待写锁）",
+                            time.perf_counter() - started)
+
+def write_many(sql: str, rows: List[Tuple]) -> int:
+    """在单个事务内用 executemany 批量写入"""
+    if not rows:
+        return 0
+    with write_transaction() as conn:
+        conn.executemany(sql, rows)
+    return len(rows)
+
+# 数据库初始化
+def init_database():
+    """初始化数据库表（多个 worker 同时启动时由写事务串行执行）"""
+    with write_transaction() as conn:
+        cursor = conn.cursor()
+        
+        # 指数数据表
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS index_data (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                code TEXT NOT NULL,
+                name TEXT NOT NULL,
+                date TEXT NOT NULL,
+                open REAL,
+                close REAL,
+                high REAL,
+                low REAL,
+                volume REAL,
+                change_percent REAL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE(code, date)
+            )
+        ''')
+        
+        # 行业数据表
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS industry_data (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                date TEXT NOT NULL,
+                change_percent REAL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE(name, date)
+            )
+        ''')
+        
+        # 交易日历表
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS trade_calendar (
+                date TEXT PRIMARY KEY
+            )
+        ''')
+
+        # 指数完整日线历史（不受保留期清理影响，增量追加）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS index_history (
+                code TEXT NOT NULL,
+                date TEXT NOT NULL,
+                open REAL,
+                close REAL,
+                high REAL,
+                low REAL,
+                volume REAL,
+                PRIMARY KEY (code, date)
+            ) WITHOUT ROWID
+        ''')
+
+        # 指数/ETF 代码注册表（可配置关注列表）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS index_registry (
+                code TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                is_major INTEGER NOT NULL DEFAULT 0,
+                enabled INTEGER NOT NULL DEFAULT 1,
+                added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.executemany(
+            "INSERT OR IGNORE INTO index_registry (code, name, is_major) VALUES (?, ?, 1)",
+            list(MAJOR_INDEXES.items())
+        )
+
+        # 流式拉取时分批暂存的行业数据：整个交易日拉取完成后一次性移入 industry_data，
+        # 避免并发的缓存读取把只保存了部分行业的交易日当作完整数据
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS industry_staging (
+                name TEXT NOT NULL,
+                date TEXT NOT NULL,
+                change_percent REAL,
+                source TEXT,
+                PRIMARY KEY (name, date)
+            ) WITHOUT ROWID
+        ''')
+
+        # 旧库迁移：记录每行行业数据的来源
+        industry_columns = {row[1] for row in cursor.execute("PRAGMA table_info(industry_data)")}
+        if "source" not in industry_columns:
+            cursor.execute("ALTER TABLE industry_data ADD COLUMN source TEXT")
+
+        # 每日市场概览（日历热力图用，随指数/行业数据写入增量物化）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS market_summary (
+                date TEXT PRIMARY KEY,
+                index_changes TEXT,
+                best_sector TEXT,
+                best_change REAL,
+                worst_sector TEXT,
+                worst_change REAL,
+                sectors_up INTEGER,
+                sectors_down INTEGER,
+                sectors_flat INTEGER,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            ) WITHOUT ROWID
+        ''')
+
+        # 分析指标（滚动收益率、波动率、排名），随数据写入增量物化
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS industry_analytics (
+                date TEXT NOT NULL,
+                period INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                return_pct REAL,
+                volatility REAL,
+                rank INTEGER,
+                PRIMARY KEY (date, period, name)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_industry_analytics_rank
+            ON industry_analytics (date, period, rank)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_industry_analytics_name
+            ON industry_analytics (name, period, date)
+        ''')
+        # 待重算的分析指标日期（数据写入时标记，由 leader 后台批量重算后删除）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS analytics_dirty (
+                kind TEXT NOT NULL,
+                date TEXT NOT NULL,
+                marked_at REAL NOT NULL,
+                PRIMARY KEY (kind, date)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS index_analytics (
+                date TEXT NOT NULL,
+                period INTEGER NOT NULL,
+                code TEXT NOT NULL,
+                return_pct REAL,
+                volatility REAL,
+                PRIMARY KEY (date, period, code)
+            ) WITHOUT ROWID
+        ''')
+
+        # 跨进程共享的响应缓存（序列化后的 JSON 响应体，按过期时间和数据日期失效）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS response_cache (
+                key TEXT PRIMARY KEY,
+                body BLOB NOT NULL,
+                ref_date TEXT,
+                expires_at REAL NOT NULL
+            ) WITHOUT ROWID
+        ''')
+
+        # 覆盖索引：按日期查询无需回表
+        # (code, date) 查询由 UNIQUE(code, date) 索引覆盖定位，按日期批量读取走 idx_index_date
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_index_date
+            ON index_data (date, code, name, open, close, high, low, volume, change_percent)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_index_code_date
+            ON index_data (code, date, name, open, close, high, low, volume, change_percent)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_industry_date
+            ON industry_data (date, change_percent, name)
+        ''')
+
+        # 新浪行业名称与同花顺分类不一致，旧版本入库的新浪快照会与其他日期混用：删除后由同花顺数据重新补齐
+        sina_dates = [row[0] for row in cursor.execute(
+            "SELECT DISTINCT date FROM industry_data WHERE source = ?", (SOURCE_SINA_SPOT,)
+        )]
+        if sina_dates:
+            earliest = min(sina_dates)
+            cursor.execute("DELETE FROM industry_data WHERE source = ?", (SOURCE_SINA_SPOT,))
+            cursor.execute(f"DELETE FROM market_summary WHERE date IN ({','.join('?' * len(sina_dates))})", sina_dates)
+            cursor.execute("DELETE FROM industry_analytics WHERE date >= ?", (earliest,))
+            cursor.execute("DELETE FROM response_cache WHERE ref_date IS NULL OR ref_date >= ?", (earliest,))
+            logger.warning(f"已删除 {len(sina_dates)} 个交易日的新浪行业快照，将按同花顺数据重新补齐")
+
+    logger.info("数据库初始化完成")
+
+INDEX_COLUMNS = ["code", "name", "date", "open", "close", "high", "low", "volume", "change_percent"]
+
+UPSERT_INDEX_SQL = '''
+    INSERT OR REPLACE INTO index_data 
+    (code, name, date, open, close, high, low, volume, change_percent)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+UPSERT_INDUSTRY_SQL = '''
+    INSERT OR REPLACE INTO industry_data 
+    (name, date, change_percent, source)
+    VALUES (?, ?, ?, ?)
+'''
+
+UPSERT_INDUSTRY_STAGING_SQL = '''
+    INSERT OR REPLACE INTO industry_staging
+    (name, date, change_percent, source)
+    VALUES (?, ?, ?, ?)
+'''
+
+# 行业数据来源标记
+SOURCE_THS_HISTORY = "ths_history"   # 同花顺行业指数日线（区间计算）
+SOURCE_THS_SUMMARY = "ths_summary"   # 同花顺行业一览（当日快照）
+SOURCE_SINA_SPOT = "sina_spot"       # 新浪行业实时行情（当日快照）
+
+def get_cached_index_data(code: str, target_date: str) -> Optional[Dict]:
+    """从缓存获取指数数据"""
+    cursor = get_read_conn().execute('''
+        SELECT code, name, date, open, close, high, low, volume, change_percent
+        FROM index_data 
+        WHERE code = ? AND date = ?
+    ''', (code, target_date))
+    row = cursor.fetchone()
+    return dict(zip(INDEX_COLUMNS, row)) if row else None
+
+def save_index_data(data: Dict):
+    """保存指数数据到数据库"""
+    write_many(UPSERT_INDEX_SQL, [tuple(data[col] for col in INDEX_COLUMNS)])
+    on_data_saved([data['date']], "index")
+
+def get_cached_industry_data(target_date: str) -> List[Dict]:
+    """从缓存获取行业数据"""
+    cursor = get_read_conn().execute('''
+        SELECT name, change_percent, date
+        FROM industry_data 
+        WHERE date = ?
+        ORDER BY change_percent DESC
+    ''', (target_date,))
+    return [{
+        "name": row[0],
+        "change_percent": row[1],
+        "date": row[2]
+    } for row in cursor.fetchall()]
+
+def get_cached_index_batch(codes: List[str], target_date: str) -> Dict[str, Tuple[Dict, float]]:
+    """一次查询获取多个指数在某日的缓存数据及写入至今的秒数（code -> (数据, 秒数)）"""
+    placeholders = ",".join("?" * len(codes))
+    cursor = get_read_conn().execute(f'''
+        SELECT code, name, date, open, close, high, low, volume, change_percent,
+               (julianday('now') - julianday(created_at)) * 86400
+        FROM index_data
+        WHERE code IN ({placeholders}) AND date = ?
+    ''', (*codes, target_date))
+    found = {row[0]: (dict(zip(INDEX_COLUMNS, row[:-1])), row[-1]) for row in cursor.fetchall()}
+    record_cache_lookup("index_data", len(found), len(codes) - len(found))
+    missing = [code for code in codes if code not in found]
+    if missing and is_archived(target_date):
+        # 保留期之外的数据从归档读取，历史数据不会再变，按刚写入处理
+        for row in read_archive("index_data", target_date, target_date, codes=missing):
+            found[row["code"]] = (row, 0.0)
+    return found
+
+def get_latest_cached_index_batch(codes: List[str], on_or_before: str) -> Dict[str, Dict]:
+    """一次查询获取多个指数在指定日期及之前最近的一条缓存（code -> 数据）"""
+    placeholders = ",".join("?" * len(codes))
+    cursor = get_read_conn().execute(f'''
+        SELECT i.code, i.name, i.date, i.open, i.close, i.high, i.low, i.volume, i.change_percent
+        FROM index_data i
+        WHERE i.code IN ({placeholders})
+          AND i.date = (SELECT MAX(date) FROM index_data WHERE code = i.code AND date <= ?)
+    ''', (*codes, on_or_before))
+    return {row[0]: dict(zip(INDEX_COLUMNS, row)) for row in cursor.fetchall()}
+
+def get_cached_index_range(codes: List[str], start_date: str, end_date: str) -> List[Dict]:
+    """一次区间查询获取多个指数在 [start, end] 内的缓存数据（按日期、代码排序，含归档部分）"""
+    placeholders = ",".join("?" * len(codes))
+    cursor = get_read_conn().execute(f'''
+        SELECT code, name, date, open, close, high, low, volume, change_percent
+        FROM index_data
+        WHERE date BETWEEN ? AND ? AND code IN ({placeholders})
+        ORDER BY date, code
+    ''', (start_date, end_date, *codes))
+    rows = [dict(zip(INDEX_COLUMNS, row)) for row in cursor.fetchall()]
+    if is_archived(start_date):
+        present = {(row["code"], row["date"]) for row in rows}
+        rows += [row for row in read_archive("index_data", start_date, end_date, codes=codes)
+                 if (row["code"], row["date"]) not in present]
+        rows.sort(key=lambda row: (row["date"], row["code"]))
+    return rows
+
+def get_index_row_states(codes: List[str], start_date: str, end_date: str) -> Dict[Tuple[str, str], bool]:
+    """[start, end] 内已缓存的指数 (code, date) -> 是否在当日定型后写入（盘中快照为 False；归档数据均已定型）"""
+    placeholders = ",".join("?" * len(codes))
+    cursor = get_read_conn().execute(f'''
+        SELECT code, date, datetime(created_at, 'localtime') >= date || ' ' || ?
+        FROM index_data
+        WHERE date BETWEEN ? AND ? AND code IN ({placeholders})
+    ''', (SETTLE_CLOCK, start_date, end_date, *codes))
+    states = {(row[0], row[1]): bool(row[2]) for row in cursor.fetchall()}
+    if is_archived(start_date):
+        for row in read_archive("index_data", start_date, end_date, codes=codes):
+            states.setdefault((row["code"], row["date"]), True)
+    return states
+
+def get_settled_industry_names(start_date: str, end_date: str) -> Dict[str, set]:
+    """[start, end] 内每个交易日在当日定型后写入的行业名称（盘中快照不算；含归档部分）"""
+    cursor = get_read_conn().execute('''
+        SELECT date, name FROM industry_data
+        WHERE date BETWEEN ? AND ? AND datetime(created_at, 'localtime') >= date || ' ' || ?
+    ''', (start_date, end_date, SETTLE_CLOCK))
+    names: Dict[str, set] = {}
+    for date_str, name in cursor.fetchall():
+        names.setdefault(date_str, set()).add(name)
+    if is_archived(start_date):
+        for row in read_archive("industry_data", start_date, end_date):
+            names.setdefault(row["date"], set()).add(row["name"])
+    return names
+
+def get_industry_first_dates() -> Dict[str, str]:
+    """每个行业最早有缓存的日期（晚于该日期的交易日都应有该行业的数据）"""
+    cursor = get_read_conn().execute("SELECT name, MIN(date) FROM industry_data GROUP BY name")
+    return dict(cursor.fetchall())
+
+def get_cached_industry_with_age(target_date: str) -> Tuple[List[Dict], Optional[float]]:
+    """从缓存获取行业数据及最近一次写入至今的秒数"""
+    row = get_read_conn().execute('''
+        SELECT (julianday('now') - julianday(MAX(created_at))) * 86400
+        FROM industry_data WHERE date = ?
+    ''', (target_date,)).fetchone()
+    if row is None or row[0] is None:
+        archived = read_archive("industry_data", target_date, target_date) if is_archived(target_date) else []
+        record_cache_lookup("industry_data", int(bool(archived)), int(not archived))
+        if archived:
+            archived.sort(key=lambda r: r["change_percent"], reverse=True)
+            return [{k: r[k] for k in ("name", "change_percent", "date")} for r in archived], 0.0
+        return [], None
+    record_cache_lookup("industry_data", 1, 0)
+    return get_cached_industry_data(target_date), row[0]
+
+def get_latest_industry_snapshot(on_or_before: str) -> List[Dict]:
+    """获取指定日期及之前最近一个有缓存的交易日的行业数据"""
+    row = get_read_conn().execute(
+        "SELECT MAX(date) FROM industry_data WHERE date <= ?", (on_or_before,)
+    ).fetchone()
+    return get_cached_industry_data(row[0]) if row and row[0] else []
+
+def is_fresh(kind: str, date_str: str, age: Optional[float]) -> bool:
+    """历史交易日数据不会再变；当日数据在 FRESHNESS_TTL 内视为新鲜"""
+    if age is None:
+        return False
+    return date_str < datetime.now().strftime("%Y-%m-%d") or age <= FRESHNESS_TTL[kind]
+
+def get_cached_industry_range(start_date: str, end_date: str) -> List[Dict]:
+    """一次区间查询获取 [start, end] 内所有行业的缓存数据（按日期升序、涨跌幅降序）"""
+    cursor = get_read_conn().execute('''
+        SELECT name, change_percent, date
+        FROM industry_data
+        WHERE date BETWEEN ? AND ?
+        ORDER BY date, change_percent DESC
+    ''', (start_date, end_date))
+    rows = [{
+        "name": row[0],
+        "change_percent": row[1],
+        "date": row[2]
+    } for row in cursor.fetchall()]
+    if is_archived(start_date):
+        present = {(row["name"], row["date"]) for row in rows}
+        rows += [{k: r[k] for k in ("name", "change_percent", "date")}
+                 for r in read_archive("industry_data", start_date, end_date)
+                 if (r["name"], r["date"]) not in present]
+        rows.sort(key=lambda row: (row["date"], -row["change_percent"]))
+    return rows
+
+def save_industry_data(data_list: List[Dict], staged: bool = False):
+    """保存行业数据到数据库（单事务批量写入）；staged 为 True 时写入暂存表，由 publish_staged_industry 统一发布"""
+    rows = [(d['name'], d['date'], d['change_percent'], d.get('source', SOURCE_THS_HISTORY)) for d in data_list]
+    if staged:
+        write_many(UPSERT_INDUSTRY_STAGING_SQL, rows)
+        return
+    write_many(UPSERT_INDUSTRY_SQL, rows)
+    on_data_saved({d['date'] for d in data_list}, "industry")
+
+def publish_staged_industry(start_date: str, end_date: str):
+    """把 [start, end] 内暂存的行业数据在一个事务内移入 industry_data"""
+    with write_transaction() as conn:
+        dates = [row[0] for row in conn.execute(
+            "SELECT DISTINCT date FROM industry_staging WHERE date BETWEEN ? AND ?", (start_date, end_date))]
+        conn.execute('''
+            INSERT OR REPLACE INTO industry_data (name, date, change_percent, source)
+            SELECT name, date, change_percent, source FROM industry_staging WHERE date BETWEEN ? AND ?
+        ''', (start_date, end_date))
+        conn.execute("DELETE FROM industry_staging WHERE date BETWEEN ? AND ?", (start_date, end_date))
+    if dates:
+        on_data_saved(dates, "industry")
+
+def on_data_saved(dates: Iterable[str], kind: str):
+    """数据写入后的派生更新：重算市场概览、标记待重算的分析指标，并失效受影响的热数据层与共享响应缓存"""
+    dates = set(dates)
+    refresh_market_summaries(dates)
+    mark_analytics_dirty(kind, dates)
+    hot_cache.invalidate(dates)
+    invalidate_shared_responses(dates)
+
+# ==================== 列式归档 ====================
+# 超出保留期的数据按 <数据库目录>/archive/<表>/<YYYY-MM>.parquet 归档，按月合并写入，读取时内存映射
+# （分析指标为派生数据，只覆盖保留期，过期后直接删除）
+ARCHIVE_KEYS = {
+    "index_data": ("code", "date"),
+    "industry_data": ("name", "date"),
+    "index_history": ("code", "date"),
+    "market_summary": ("date",),
+}
+ARCHIVE_COLUMNS = {
+    "index_data": INDEX_COLUMNS,
+    "industry_data": ["name", "date", "change_percent", "source"],
+    "index_history": ["code", "date", "open", "close", "high", "low", "volume"],
+    "market_summary": ["date", "index_changes", "best_sector", "best_change", "worst_sector", "worst_change",
+                       "sectors_up", "sectors_down", "sectors_flat"],
+}
+_archive_tables: "OrderedDict[Tuple[str, int], Any]" = OrderedDict()  # (路径, mtime) -> pyarrow.Table
+_archive_lock = threading.Lock()
+
+def archive_cutoff() -> str:
+    """保留期起点：早于该日期的数据只存在于归档"""
+    return (datetime.now() - timedelta(days=DATA_RETENTION_DAYS)).strftime('%Y-%m-%d')
+
+def is_archived(date_str: str) -> bool:
+    return ARCHIVE_ENABLED and date_str < archive_cutoff()
+
+def _archive_path(table: str, month: str) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "archive", table, f"{month}.parquet")
+
+def _archive_schema(table: str):
+    text_columns = {"code", "name", "date", "source", "index_changes", "best_sector", "worst_sector"}
+    int_columns = {"sectors_up", "sectors_down", "sectors_flat"}
+    return pa.schema([
+        (col, pa.string() if col in text_columns else pa.int64() if col in int_columns else pa.float64())
+        for col in ARCHIVE_COLUMNS[table]
+    ])
+
+def _months_between(start_date: str, end_date: str) -> List[str]:
+    months, month = [], start_date[:7]
+    while month <= end_date[:7]:
+        months.append(month)
+        year, mon = int(month[:4]), int(month[5:7])
+        month = f"{year + mon // 12:04d}-{mon % 12 + 1:02d}"
+    return months
+
+def _open_archive(path: str):
+    """打开（内存映射）某月归档文件，按 mtime 缓存最近打开的月份"""
+    try:
+        key = (path, os.stat(path).st_mtime_ns)
+    except FileNotFoundError:
+        return None
+    with _archive_lock:
+        table = _archive_tables.get(key)
+        if table is not None:
+            _archive_tables.move_to_end(key)
+            return table
+    table = pq.read_table(path, memory_map=True)
+    with _archive_lock:
+        _archive_tables[key] = table
+        while len(_archive_tables) > ARCHIVE_TABLE_CACHE_SIZE:
+            _archive_tables.popitem(last=False)
+    return table
+
+def read_archive(table: str, start_date: str, end_date: str, codes: Optional[List[str]] = None) -> List[Dict]:
+    """从归档读取 [start, end] 内的记录（可按代码过滤）"""
+    end_date = min(end_date, archive_cutoff())
+    rows: List[Dict] = []
+    for month in _months_between(start_date, end_date):
+        data = _open_archive(_archive_path(table, month))
+        if data is None:
+            continue
+        mask = pc.and_(pc.greater_equal(data["date"], start_date), pc.less_equal(data["date"], end_date))
+        if codes is not None:
+            mask = pc.and_(mask, pc.is_in(data["code"], value_set=pa.array(codes, pa.string())))
+        rows.extend(data.filter(mask).to_pylist())
+    return rows
+
+def write_archive(table: str, month: str, rows: List[Dict]) -> int:
+    """把某月的记录合并进归档文件（同 key 以新数据为准），先写临时文件再原子替换"""
+    path = _archive_path(table, month)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    key_columns = ARCHIVE_KEYS[table]
+    merged: Dict[Tuple, Dict] = {}
+    existing = _open_archive(path)
+    if existing is not None:
+        for row in existing.to_pylist():
+            merged[tuple(row[k] for k in key_columns)] = row
+    for row in rows:
+        merged[tuple(row[k] for k in key_columns)] = {col: row.get(col) for col in ARCHIVE_COLUMNS[table]}
+    ordered = [merged[k] for k in sorted(merged, key=lambda k: (merged[k]["date"], k))]
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    pq.write_table(pa.Table.from_pylist(ordered, schema=_archive_schema(table)), tmp_path,
+                   compression=ARCHIVE_COMPRESSION)
+    os.replace(tmp_path, path)
+    return len(rows)
+
+def archive_expired_data(cutoff_date: str) -> List[Tuple[str, str]]:
+    """把早于 cutoff 的数据（ARCHIVE_COLUMNS 中的各表）按月归档，返回已成功归档的 (表, 月份) 列表"""
+    archived = []
+    conn = get_read_conn()
+    for table, columns in ARCHIVE_COLUMNS.items():
+        cursor = conn.execute(f"SELECT {', '.join(columns)} FROM {table} WHERE date < ? ORDER BY date", (cutoff_date,))
+        by_month: Dict[str, List[Dict]] = {}
+        for row in cursor.fetchall():
+            by_month.setdefault(row[columns.index("date")][:7], []).append(dict(zip(columns, row)))
+        for month, rows in by_month.items():
+            try:
+                write_archive(table, month, rows)
+                archived.append((table, month))
+            except Exception as e:
+                logger.error(f"归档 {table} {month} 失败（保留在数据库中）: {e}")
+    return archived
+
+# ==================== 共享响应缓存 ====================
+# 各 worker 进程共用同一个 SQLite 文件：任一进程生成的响应体其他进程可直接复用
+def get_shared_response(key: str) -> Optional[bytes]:
+    row = get_read_conn().execute(
+        "SELECT body FROM response_cache WHERE key = ? AND expires_at > ?", (key, time.time())
+    ).fetchone()
+    return row[0] if row else None
+
+def put_shared_response(key: str, body: bytes, ref_date: Optional[str], max_age: int):
+    write_many(
+        "INSERT OR REPLACE INTO response_cache (key, body, ref_date, expires_at) VALUES (?, ?, ?, ?)",
+        [(key, body, ref_date, time.time() + max_age)]
+    )
+
+def invalidate_shared_responses(dates: Iterable[str]):
+    """删除可能包含这些日期数据的缓存响应（当日响应和数据日期不早于最早写入日期的响应）"""
+    dates = sorted(dates)
+    if not dates:
+        return
+    with write_transaction() as conn:
+        conn.execute("DELETE FROM response_cache WHERE ref_date IS NULL OR ref_date >= ?", (dates[0],))
+
+# ==================== 市场概览物化 ====================
+def refresh_market_summaries(dates: Iterable[str]) -> int:
+    """重新计算指定交易日的市场概览并写入 market_summary（数据写入后调用）"""
+    dates = sorted(set(dates))
+    if not dates:
+        return 0
+    placeholders = ",".join("?" * len(dates))
+    conn = get_read_conn()
+
+    majors = set(major_index_codes())
+    index_changes: Dict[str, Dict[str, float]] = {d: {} for d in dates}
+    for code, date, change in conn.execute(
+        f"SELECT code, date, change_percent FROM index_data WHERE date IN ({placeholders})", dates
+    ):
+        if code in majors:
+            index_changes[date][code] = change
+
+    sectors: Dict[str, List[Tuple[str, float]]] = {d: [] for d in dates}
+    for name, date, change in conn.execute(
+        f"SELECT name, date, change_percent FROM industry_data WHERE date IN ({placeholders})", dates
+    ):
+        if change is not None:
+            sectors[date].append((name, change))
+
+    rows = []
+    for date in dates:
+        day_sectors = sectors[date]
+        if not index_changes[date] and not day_sectors:
+            continue
+        best = max(day_sectors, key=lambda x: x[1]) if day_sectors else (None, None)
+        worst = min(day_sectors, key=lambda x: x[1]) if day_sectors else (None, None)
+        rows.append((
+            date,
+            json.dumps(index_changes[date], ensure_ascii=False),
+            best[0], best[1], worst[0], worst[1],
+            sum(1 for _, c in day_sectors if c > 0),
+            sum(1 for _, c in day_sectors if c < 0),
+            sum(1 for _, c in day_sectors if c == 0)
+        ))
+
+    return write_many('''
+        INSERT OR REPLACE INTO market_summary
+        (date, index_changes, best_sector, best_change, worst_sector, worst_change,
+         sectors_up, sectors_down, sectors_flat)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+
+def backfill_market_summaries():
+    """为已有数据但缺少概览的交易日补算概览（启动时后台执行）"""
+    try:
+        cursor = get_read_conn().execute('''
+            SELECT date FROM index_data
+            UNION
+            SELECT date FROM industry_data
+            EXCEPT
+            SELECT date FROM market_summary
+        ''')
+        missing = [row[0] for row in cursor.fetchall()]
+        if missing:
+            count = refresh_market_summaries(missing)
+            logger.info(f"市场概览补算完成，共 {count} 个交易日")
+    except Exception as e:
+        logger.error(f"市场概览补算失败: {e}")
+
+def get_market_summaries(start_date: str, end_date: str) -> List[Dict]:
+    """一次索引区间读取 [start, end] 内的市场概览（含归档部分）"""
+    cursor = get_read_conn().execute('''
+        SELECT date, index_changes, best_sector, best_change, worst_sector, worst_change,
+               sectors_up, sectors_down, sectors_flat
+        FROM market_summary
+        WHERE date BETWEEN ? AND ?
+        ORDER BY date
+    ''', (start_date, end_date))
+    rows = cursor.fetchall()
+    if is_archived(start_date):
+        present = {row[0] for row in rows}
+        columns = ARCHIVE_COLUMNS["market_summary"]
+        rows += [tuple(row[col] for col in columns) for row in read_archive("market_summary", start_date, end_date)
+                 if row["date"] not in present]
+        rows.sort(key=lambda row: row[0])
+    return [{
+        "date": row[0],
+        "indexes": json.loads(row[1]) if row[1] else {},
+        "best_sector": {"name": row[2], "change_percent": row[3]} if row[2] else None,
+        "worst_sector": {"name": row[4], "change_percent": row[5]} if row[4] else None,
+        "breadth": {"up": row[6], "down": row[7], "flat": row[8]}
+    } for row in rows]
+
+# ==================== 分析指标物化 ====================
+def compute_rolling_analytics(frame: "pd.DataFrame", key: str) -> "pd.DataFrame":
+    """向量化计算每个 (key, date, period) 的区间复合收益率、日涨跌幅标准差及当日排名
+
+    frame 列为 key, date, change_percent；某天缺数据的窗口结果为空，不参与排名。
+    返回列：date, period, key, return_pct, volatility, rank
+    """
+    wide = frame.pivot_table(index="date", columns=key, values="change_percent").sort_index()
+    log_growth = np.log1p(wide / 100)
+    parts = []
+    for period in ANALYTICS_PERIODS:
+        returns = (np.expm1(log_growth.rolling(period, min_periods=period).sum()) * 100).round(2)
+        volatility = wide.rolling(period, min_periods=period).std().round(3)
+        long = pd.DataFrame({
+            "return_pct": returns.stack(),
+            "volatility": volatility.stack(),
+        }).dropna(subset=["return_pct"]).reset_index()
+        long["period"] = period
+        long["rank"] = long.groupby("date")["return_pct"].rank(ascending=False, method="min").astype(int)
+        parts.append(long)
+    result = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame()
+    return result[["date", "period", key, "return_pct", "volatility", "rank"]] if not result.empty else result
+
+ANALYTICS_SOURCES = {
+    "index": ("index_data", "index_analytics", "code"),
+    "industry": ("industry_data", "industry_analytics", "name"),
+}
+
+def _affected_ranges(dates: List[str], latest: str) -> List[Tuple[str, str]]:
+    """某日数据变化只影响窗口覆盖到它的输出日期：[该日, 其后第 (最长窗口-1) 个交易日]，重叠的区间合并"""
+    ranges: List[List[str]] = []
+    for date in sorted(dates):
+        if date > latest:
+            break
+        end = min(trading_day_after(date, max(ANALYTICS_PERIODS) - 1) or date, latest)
+        if ranges and date <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], end)
+        else:
+            ranges.append([date, end])
+    return [(start, end) for start, end in ranges]
+
+def refresh_analytics(kind: str, dates: Iterable[str]) -> int:
+    """重算受影响交易日的分析指标，只改写窗口覆盖到变化日期的输出日期；返回写入条数"""
+    source, table, key = ANALYTICS_SOURCES[kind]
+    latest = get_read_conn().execute(f"SELECT MAX(date) FROM {source}").fetchone()[0]
+    if latest is None:
+        return 0
+    columns = ["date", "period", key, "return_pct", "volatility"] + (["rank"] if kind == "industry" else [])
+    written = 0
+    for start, end in _affected_ranges(list(dates), latest):
+        since = trading_day_before(start, max(ANALYTICS_PERIODS) - 1) or start
+        if kind == "index":
+            rows = get_cached_index_range(list(get_index_registry()), since, end)
+        else:
+            rows = get_cached_industry_range(since, end)
+        records: List[Tuple] = []
+        if rows:
+            result = compute_rolling_analytics(pd.DataFrame(rows)[[key, "date", "change_percent"]], key)
+            if not result.empty:
+                result = result[(result["date"] >= start) & (result["date"] <= end)]
+                records = [tuple(v.item() if hasattr(v, "item") else v for v in record)
+                           for record in result[columns].itertuples(index=False, name=None)]
+        with write_transaction() as conn:
+            conn.execute(f"DELETE FROM {table} WHERE date >= ? AND date <= ?", (start, end))
+            conn.executemany(
+                f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})", records
+            )
+        written += len(records)
+    return written
+
+def mark_analytics_dirty(kind: str, dates: Iterable[str]):
+    """记录待重算的日期（写路径上只做这一次小写入），并唤醒本进程的后台重算"""
+    now = time.time()
+    write_many("INSERT OR REPLACE INTO analytics_dirty (kind, date, marked_at) VALUES (?, ?, ?)",
+               [(kind, date, now) for date in dates])
+    analytics_refresher.notify()
+
+class AnalyticsRefresher:
+    """分析指标的后台增量重算（仅 leader 运行）
+
+    数据写入只在 analytics_dirty 中标记日期；本进程写入时立即唤醒并等待 ANALYTICS_DEBOUNCE_SECONDS
+    合并后续写入，其他 worker 的标记按 ANALYTICS_POLL_SECONDS 轮询。每批每类数据只重算一次。
+    """
+
+    def __init__(self):
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.status: Dict[str, Any] = {
+            "runs": 0,
+            "last_finished": None,
+            "last_duration": None,
+            "last_rows": None,
+            "last_error": None,
+        }
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="analytics-refresher", daemon=True)
+            self._thread.start()
+
+    def notify(self):
+        self._wake.set()
+
+    def _loop(self):
+        while True:
+            if self._wake.wait(ANALYTICS_POLL_SECONDS):
+                time.sleep(ANALYTICS_DEBOUNCE_SECONDS)
+            self._wake.clear()
+            try:
+                self.run_once()
+            except Exception as e:
+                self.status["last_error"] = str(e)
+                logger.error(f"分析指标重算失败: {e}")
+
+    def run_once(self) -> int:
+        """处理当前全部待重算标记；重算期间被再次标记的日期保留到下一批"""
+        started = time.monotonic()
+        written = 0
+        for kind in ANALYTICS_SOURCES:
+            marks = get_read_conn().execute(
+                "SELECT date, marked_at FROM analytics_dirty WHERE kind = ?", (kind,)
+            ).fetchall()
+            if not marks:
+                continue
+            written += refresh_analytics(kind, [date for date, _ in marks])
+            write_many("DELETE FROM analytics_dirty WHERE kind = ? AND date = ? AND marked_at <= ?",
+                       [(kind, date, marked_at) for date, marked_at in marks])
+        if written:
+            logger.info(f"分析指标重算完成，共 {written} 条，耗时 {time.monotonic() - started:.2f}s")
+        self.status.update({
+            "runs": self.status["runs"] + 1,
+            "last_finished": datetime.now().isoformat(timespec="seconds"),
+            "last_duration": round(time.monotonic() - started, 3),
+            "last_rows": written,
+            "last_error": None,
+        })
+        return written
+
+analytics_refresher = AnalyticsRefresher()
+
+def backfill_analytics():
+    """把已有数据但缺少分析指标的交易日标记为待重算（启动时后台执行）"""
+    for kind, (source, table, _) in ANALYTICS_SOURCES.items():
+        try:
+            cursor = get_read_conn().execute(f"SELECT date FROM {source} EXCEPT SELECT date FROM {table}")
+            missing = [row[0] for row in cursor.fetchall()]
+            if missing:
+                mark_analytics_dirty(kind, missing)
+                logger.info(f"{kind} 分析指标待补算 {len(missing)} 个交易日")
+        except Exception as e:
+            logger.error(f"{kind} 分析指标补算失败: {e}")
+
+def get_industry_top(period: int, n: int, date: Optional[str], ascending: bool) -> Tuple[Optional[str], List[Dict]]:
+    """按排名索引读取某日某窗口的前/后 n 名行业；date 为空时取最新一天"""
+    conn = get_read_conn()
+    if date is None:
+        date = conn.execute(
+            "SELECT MAX(date) FROM industry_analytics WHERE period = ?", (period,)
+        ).fetchone()[0]
+    if date is None:
+        return None, []
+    cursor = conn.execute(f'''
+        SELECT name, return_pct, volatility, rank
+        FROM industry_analytics
+        WHERE date = ? AND period = ?
+        ORDER BY rank {"DESC" if ascending else "ASC"}
+        LIMIT ?
+    ''', (date, period, n))
+    return date, [{"name": row[0], "return_pct": row[1], "volatility": row[2], "rank": row[3]}
+                  for row in cursor.fetchall()]
+
+def get_industry_rank_history(name: str, period: int, start_date: str, end_date: str) -> List[Dict]:
+    cursor = get_read_conn().execute('''
+        SELECT date, return_pct, volatility, rank
+        FROM industry_analytics
+        WHERE name = ? AND period = ? AND date BETWEEN ? AND ?
+        ORDER BY date
+    ''', (name, period, start_date, end_date))
+    return [{"date": row[0], "return_pct": row[1], "volatility": row[2], "rank": row[3]} for row in cursor.fetchall()]
+
+def get_index_analytics(codes: List[str], date: str) -> List[Dict]:
+    placeholders = ",".join("?" * len(codes))
+    cursor = get_read_conn().execute(f'''
+        SELECT code, period, return_pct, volatility
+        FROM index_analytics
+        WHERE date = ? AND code IN ({placeholders})
+        ORDER BY code, period
+    ''', (date, *codes))
+    result: Dict[str, Dict] = {}
+    for code, period, return_pct, volatility in cursor.fetchall():
+        entry = result.setdefault(code, {"code": code, "name": index_name(code), "date": date})
+        entry[f"return_{period}d"] = return_pct
+        entry[f"volatility_{period}d"] = volatility
+    return [result[code] for code in codes if code in result]
+
+# ==================== 并发抓取引擎 ====================
+class TokenBucket:
+    """线程安全的令牌桶限流器"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """阻塞直到拿到一个令牌"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_seconds = (1 - self._tokens) / self.rate
+            time.sleep(wait_seconds)
+
+# 所有上游调用（call_upstream）共享同一个限流器
+upstream_limiter = TokenBucket(FETCH_RATE_PER_SEC, FETCH_BURST)
+
+class FetchReport:
+    """一次批量抓取的结果统计"""
+
+    def __init__(self, label: str, total: int):
+        self.label = label
+        self.total = total
+        self.succeeded = 0
+        self.failed = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.failed_keys: List[Any] = []
+        self.elapsed = 0.0
+
+    def to_dict(self) -> Dict:
+        return {
+            "label": self.label,
+            "total": self.total,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "retries": self.retries,
+            "timeouts": self.timeouts,
+            "failed_keys": self.failed_keys,
+            "elapsed": round(self.elapsed, 3)
+        }
+
+    def __str__(self):
+        return (f"{self.label}: 成功 {self.succeeded}/{self.total}，失败 {self.failed}，"
+                f"重试 {self.retries} 次，超时 {self.timeouts} 次，耗时 {self.elapsed:.1f}s")
+
+def fan_out_fetch(
+    keys: Iterable[Any],
+    fetch_fn: Callable[[Any], Any],
+    label: str = "上游抓取",
+    max_workers: int = FETCH_MAX_WORKERS,
+    timeout: float = FETCH_TASK_TIMEOUT,
+    retries: int = FETCH_MAX_RETRIES,
+    on_result: Optional[Callable[[Any, Any], None]] = None
+) -> Tuple[Dict[Any, Any], FetchReport]:
+    """有界并发地对每个 key 调用 fetch_fn，带单任务超时和重试
+
+    限流不在这里：任务可能只读本地数据，也可能发起多次上游调用，令牌在 call_upstream 中按实际调用获取。
+    超时的请求无法强制中断，只会被放弃并按失败处理（可重试）；
+    返回 (key -> 结果, 统计报告)，失败的 key 不出现在结果中。
+    on_result 不为空时，每个 key 成功后立即在协调线程中回调 on_result(key, 结果)。
+    """
+    keys = list(keys)
+    report = FetchReport(label, len(keys))
+    task = label.split(" ")[0]  # 去掉日期区间，作为指标标签
+    metrics.set("fetch_batch_total", "当前/最近一批扇出抓取的任务数", len(keys), task=task)
+    metrics.set("fetch_batch_done", "当前/最近一批扇出抓取已完成（成功或最终失败）的任务数", 0, task=task)
+    results: Dict[Any, Any] = {}
+    todo = deque((key, 0) for key in keys)
+    running: Dict[Any, Tuple[Any, int, float]] = {}  # future -> (key, 第几次尝试, 开始时间)
+    # 额外的线程用来容纳被放弃但仍在运行的超时请求
+    executor = ThreadPoolExecutor(max_workers=max_workers * 2, thread_name_prefix="fetch")
+    start = time.monotonic()
+
+    try:
+        while todo or running:
+            while todo and len(running) < max_workers:
+                key, attempt = todo.popleft()
+                running[executor.submit(fetch_fn, key)] = (key, attempt, time.monotonic())
+
+            done, _ = wait(list(running), timeout=0.5, return_when=FIRST_COMPLETED)
+            now = time.monotonic()
+            for future in list(running):
+                key, attempt, started = running[future]
+                if future in done:
+                    del running[future]
+                    try:
+                        results[key] = future.result()
+                        report.succeeded += 1
+                        metrics.set("fetch_batch_done", "当前/最近一批扇出抓取已完成（成功或最终失败）的任务数",
+                                    report.succeeded + report.failed, task=task)
+                        if on_result is not None:
+                            try:
+                                on_result(key, results[key])
+                            except Exception as e:
+                                logger.warning(f"{label} [{key}] 结果回调失败: {e}")
+                        continue
+                    except Exception as e:
+                        error = e
+                elif now - started > timeout:
+                    del running[future]
+                    report.timeouts += 1
+                    error = TimeoutError(f"超过 {timeout}s 未返回")
+                else:
+                    continue
+
+                if attempt < retries and not isinstance(error, CircuitOpenError):
+                    report.retries += 1
+                    todo.append((key, attempt + 1))
+                else:
+                    report.failed += 1
+                    report.failed_keys.append(key)
+                    metrics.set("fetch_batch_done", "当前/最近一批扇出抓取已完成（成功或最终失败）的任务数",
+                                report.succeeded + report.failed, task=task)
+                    metrics.inc("fetch_failures_total", "扇出抓取最终失败的任务数", task=task)
+                    logger.debug(f"{label} [{key}] 最终失败: {error}")
+    finally:
+        executor.shutdown(wait=False)
+
+    report.elapsed = time.monotonic() - start
+    metrics.observe("fetch_batch_duration_seconds", "扇出抓取整批耗时（秒）", report.elapsed, task=task)
+    logger.info(str(report))
+    return results, report
+
+# ==================== 上游熔断 ====================
+class CircuitOpenError(Exception):
+    """熔断期间拒绝上游调用"""
+
+class CircuitBreaker:
+    """上游调用熔断器：closed -> open（指数退避冷却）-> half_open（单个探测）-> closed"""
+
+    def __init__(self, failure_threshold: int, base_cooldown: float, max_cooldown: float):
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.cooldown = base_cooldown
+        self.opened_at = 0.0
+        self.rejected = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _before_call(self):
+        with self._lock:
+            if self.state == "open":
+                remaining = self.cooldown - (time.monotonic() - self.opened_at)
+                if remaining > 0:
+                    self.rejected += 1
+                    raise CircuitOpenError(f"上游熔断中，{remaining:.0f}s 后重试")
+                self.state = "half_open"
+                self._probing = False
+            if self.state == "half_open":
+                if self._probing:
+                    self.rejected += 1
+                    raise CircuitOpenError("上游熔断半开，正在探测")
+                self._probing = True
+
+    def _on_success(self):
+        with self._lock:
+            if self.state == "half_open":
+                logger.info("上游探测成功，熔断关闭")
+            self.state = "closed"
+            self.failures = 0
+            self.cooldown = self.base_cooldown
+            self._probing = False
+
+    def _on_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open":
+                self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+                self._open()
+            elif self.state == "closed" and self.failures >= self.failure_threshold:
+                self._open()
+
+    def _open(self):
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self._probing = False
+        logger.warning(f"上游连续失败 {self.failures} 次，熔断 {self.cooldown:.0f}s")
+
+    def call(self, fn: Callable, *args, **kwargs):
+        self._before_call()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self._on_failure()
+            raise
+        self._on_success()
+        return result
+
+    def stats(self) -> Dict:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "cooldown": self.cooldown,
+            "rejected": self.rejected
+        }
+
+upstream_breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_BASE_COOLDOWN, BREAKER_MAX_COOLDOWN)
+
+def call_upstream(fn: Callable, *args, **kwargs):
+    """所有 akshare 调用的统一入口：熔断器放行后按令牌桶限流，按函数统计次数与耗时（不含等待令牌）"""
+    name = getattr(fn, "__name__", "unknown")
+    started = None
+    outcome = "error"
+
+    def limited():
+        nonlocal started
+        upstream_limiter.acquire()
+        started = time.perf_counter()
+        return fn(*args, **kwargs)
+
+    try:
+        result = upstream_breaker.call(limited)
+        outcome = "ok"
+        return result
+    except CircuitOpenError:
+        outcome = "rejected"
+        raise
+    finally:
+        if started is not None:
+            metrics.observe("upstream_call_duration_seconds", "akshare 调用耗时（秒）",
+                            time.perf_counter() - started, func=name)
+        metrics.inc("upstream_calls_total", "akshare 调用次数", func=name, outcome=outcome)
+
+# ==================== 阻塞任务执行层 ====================
+# 上游拉取可能耗时数分钟，与数据库读写分开，避免慢请求占满缓存命中路径的线程
+upstream_executor = ThreadPoolExecutor(max_workers=UPSTREAM_EXECUTOR_WORKERS, thread_name_prefix="upstream")
+db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+
+async def run_upstream(fn: Callable, *args, **kwargs):
+    """在上游线程池中执行阻塞的 akshare 调用"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(upstream_executor, functools.partial(fn, *args, **kwargs))
+
+async def run_db(fn: Callable, *args, **kwargs):
+    """在数据库线程池中执行阻塞的 SQLite 操作（按函数统计执行耗时，不含排队时间）"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(_timed_db_call, fn, *args, **kwargs))
+
+def _timed_db_call(fn: Callable, *args, **kwargs):
+    started = time.perf_counter()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        metrics.observe("sqlite_task_duration_seconds", "数据库任务耗时（秒）",
+                        time.perf_counter() - started, task=getattr(fn, "__name__", "unknown"))
+
+# ==================== 单飞请求合并 ====================
+class SingleFlight:
+    """同一 key 的并发请求只执行一次拉取，其余请求等待并共享结果"""
+
+    def __init__(self):
+        self._inflight: Dict[Any, asyncio.Future] = {}
+        self.leaders = 0     # 实际发起拉取的次数
+        self.coalesced = 0   # 被合并（搭便车）的请求数
+
+    async def do(self, key: Any, coro_fn: Callable):
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            logger.info(f"请求合并: {key} 已有拉取在途，等待共享结果")
+        else:
+            self.leaders += 1
+            future = asyncio.ensure_future(coro_fn())
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shield：某个客户端断开不会取消其他请求共享的拉取
+        return await asyncio.shield(future)
+
+    def is_inflight(self, key: Any) -> bool:
+        return key in self._inflight
+
+    def stats(self) -> Dict:
+        return {"leaders": self.leaders, "coalesced": self.coalesced, "inflight": len(self._inflight)}
+
+live_fetch_flight = SingleFlight()
+
+def _log_background_result(future: asyncio.Future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning(f"后台刷新失败: {future.exception()}")
+
+def refresh_in_background(key: Any, coro_fn: Callable):
+    """返回旧快照的同时在后台刷新（同一 key 已在刷新时不重复发起）"""
+    if live_fetch_flight.is_inflight(key):
+        return
+    asyncio.ensure_future(live_fetch_flight.do(key, coro_fn)).add_done_callback(_log_background_result)
+
+# ==================== 交易日历 ====================
+# 内存中的交易日列表（升序，YYYY-MM-DD），由 trade_calendar 表加载
+_trade_days: List[str] = []
+_trade_calendar_lock = threading.Lock()
+_trade_calendar_refreshed_on: Optional[str] = None  # 最近一次成功向上游扩展日历的日期
+_trade_calendar_retry_at = 0.0       # 上游失败后，下次允许重试的时间（time.monotonic）
+_trade_calendar_failures = 0         # 连续失败次数，用于指数退避
+
+def _fetch_trade_days_upstream() -> List[str]:
+    """一次性从上游批量获取交易日历（新浪交易日历，失败时用上证指数日线日期兜底）"""
+    try:
+        df = call_upstream(ak.tool_trade_date_hist_sina)
+        return sorted(pd.to_datetime(df["trade_date"]).dt.strftime("%Y-%m-%d").tolist())
+    except Exception as e:
+        logger.warning(f"获取新浪交易日历失败，改用上证指数日线日期: {e}")
+        df = call_upstream(ak.stock_zh_index_daily, symbol="sh000001")
+        return sorted(pd.to_datetime(df["date"]).dt.strftime("%Y-%m-%d").tolist())
+
+def refresh_trade_calendar(force: bool = False):
+    """从数据库加载交易日历；为空或已过期时从上游增量扩展"""
+    global _trade_days, _trade_calendar_refreshed_on, _trade_calendar_retry_at, _trade_calendar_failures
+    today_str = datetime.now().strftime("%Y-%m-%d")
+    with _trade_calendar_lock:
+        cursor = get_read_conn().execute("SELECT date FROM trade_calendar ORDER BY date")
+        days = [row[0] for row in cursor.fetchall()]
+
+        # 日历为空或未覆盖今天时才访问上游：成功后当天不再访问，失败后按指数退避重试
+        need_upstream = force or not days or days[-1] < today_str
+        if (need_upstream and _trade_calendar_refreshed_on != today_str
+                and (force or time.monotonic() >= _trade_calendar_retry_at)):
+            try:
+                last = days[-1] if days else ""
+                new_days = [d for d in _fetch_trade_days_upstream() if d > last]
+                if new_days:
+                    write_many("INSERT OR IGNORE INTO trade_calendar (date) VALUES (?)", [(d,) for d in new_days])
+                    days.extend(new_days)
+                    logger.info(f"交易日历已扩展 {len(new_days)} 天，最新至 {days[-1]}")
+                _trade_calendar_refreshed_on = today_str
+                _trade_calendar_failures = 0
+            except Exception as e:
+                delay = min(CALENDAR_RETRY_BASE * 2 ** _trade_calendar_failures, CALENDAR_RETRY_MAX)
+                _trade_calendar_failures += 1
+                _trade_calendar_retry_at = time.monotonic() + delay
+                logger.error(f"扩展交易日历失败，{delay:.0f}s 后重试: {e}")
+
+        _trade_days = days
+
+def _ensure_trade_calendar(date_str: str):
+    """保证内存日历已加载且覆盖指定日期"""
+    if not _trade_days:
+        refresh_trade_calendar()
+    elif (date_str > _trade_days[-1] and _trade_calendar_refreshed_on != datetime.now().strftime("%Y-%m-%d")
+          and time.monotonic() >= _trade_calendar_retry_at):
+        refresh_trade_calendar()
+
+def is_trading_day(date_str: str) -> bool:
+    """判断是否为交易日"""
+    _ensure_trade_calendar(date_str)
+    idx = bisect.bisect_left(_trade_days, date_str)
+    return idx < len(_trade_days) and _trade_days[idx] == date_str
+
+def nearest_trading_day(date_str: str) -> Optional[str]:
+    """返回不晚于指定日期的最近交易日"""
+    _ensure_trade_calendar(date_str)
+    idx = bisect.bisect_right(_trade_days, date_str)
+    return _trade_days[idx - 1] if idx > 0 else None
+
+def prev_trading_day(date_str: str) -> Optional[str]:
+    """返回严格早于指定日期的前一交易日"""
+    _ensure_trade_calendar(date_str)
+    idx = bisect.bisect_left(_trade_days, date_str)
+    return _trade_days[idx - 1] if idx > 0 else None
+
+def trading_day_after(date_str: str, n: int) -> Optional[str]:
+    """返回不早于指定日期的第 n 个交易日（日历不足时返回最晚的交易日）"""
+    _ensure_trade_calendar(date_str)
+    idx = bisect.bisect_left(_trade_days, date_str) + n
+    return _trade_days[min(idx, len(_trade_days) - 1)] if _trade_days else None
+
+def trading_day_before(date_str: str, n: int) -> Optional[str]:
+    """返回早于指定日期的第 n 个交易日（日历不足时返回最早的交易日）"""
+    _ensure_trade_calendar(date_str)
+    idx = bisect.bisect_left(_trade_days, date_str) - n
+    return _trade_days[max(idx, 0)] if _trade_days else None
+
+def next_trading_day(date_str: str) -> Optional[str]:
+    """返回严格晚于指定日期的下一交易日"""
+    _ensure_trade_calendar(date_str)
+    idx = bisect.bisect_right(_trade_days, date_str)
+    return _trade_days[idx] if idx < len(_trade_days) else None
+
+def trading_days_between(start_str: str, end_str: str) -> List[str]:
+    """返回 [start, end] 区间内的所有交易日"""
+    _ensure_trade_calendar(end_str)
+    lo = bisect.bisect_left(_trade_days, start_str)
+    hi = bisect.bisect_right(_trade_days, end_str)
+    return _trade_days[lo:hi]
+
+def last_settled_trading_day() -> Optional[str]:
+    """最近一个数据已定型的交易日：收盘 + REFRESH_DELAY_AFTER_CLOSE 之后上游数据才视为最终值，
+    在此之前返回前一交易日（与收盘后定时刷新的时间边界一致）"""
+    shifted = datetime.now() - REFRESH_DELAY_AFTER_CLOSE
+    shifted_str = shifted.strftime("%Y-%m-%d")
+    if shifted.time() >= MARKET_CLOSE_TIME:
+        return nearest_trading_day(shifted_str)
+    return prev_trading_day(shifted_str)
+
+def resolve_trading_day(target_date: datetime) -> Optional[str]:
+    """把请求日期解析为实际交易日：今天开盘前视为尚无当日数据，取前一交易日"""
+    date_str = target_date.strftime("%Y-%m-%d")
+    now = datetime.now()
+    if date_str == now.strftime("%Y-%m-%d") and now.time() < MARKET_OPEN_TIME:
+        return prev_trading_day(date_str)
+    return nearest_trading_day(date_str)
+
+# ==================== 行业历史数据加载 ====================
+def fetch_industry_history(industry: str, start_str: str, end_str: str) -> "pd.DataFrame":
+    """单次区间调用获取某行业 [start, end] 内每个交易日的涨跌幅
+
+    请求区间向前多取一个交易日作为基准，涨跌幅由收盘价整列 shift 向量化计算。
+    返回列：name, date, change_percent, source
+    """
+    base_str = prev_trading_day(start_str) or start_str
+    df = call_upstream(
+        ak.stock_board_industry_index_ths,
+        symbol=industry,
+        start_date=base_str.replace("-", ""),
+        end_date=end_str.replace("-", "")
+    )
+    if df.empty or "收盘价" not in df.columns:
+        return pd.DataFrame(columns=["name", "date", "change_percent", "source"])
+
+    frame = pd.DataFrame({
+        "date": pd.to_datetime(df["日期"]).dt.strftime("%Y-%m-%d"),
+        "close": df["收盘价"].astype(float)
+    }).sort_values("date")
+    frame["change_percent"] = ((frame["close"] / frame["close"].shift(1) - 1) * 100).round(2)
+    frame = frame[(frame["date"] >= start_str) & (frame["date"] <= end_str)].dropna(subset=["change_percent"])
+    frame["name"] = industry
+    frame["source"] = SOURCE_THS_HISTORY
+    return frame[["name", "date", "change_percent", "source"]]
+
+def load_industry_history(
+    industry_list: List[str],
+    start_str: str,
+    end_str: str,
+    on_rows: Optional[Callable[[List[Dict]], None]] = None
+) -> Tuple["pd.DataFrame", FetchReport]:
+    """按行业并发区间拉取并入库（每个行业一次上游调用）
+
+    默认全部完成后整体入库；on_rows 不为空时（流式）每个行业算完即回调，
+    并每累计 INDUSTRY_STREAM_SAVE_BATCH 条记录分批写入暂存表，全部完成后一次性发布。
+    """
+    pending: List[Dict] = []
+
+    def stream_frame(industry: str, frame: "pd.DataFrame"):
+        if frame.empty:
+            return
+        records = frame.to_dict("records")
+        on_rows(records)
+        pending.extend(records)
+        if len(pending) >= INDUSTRY_STREAM_SAVE_BATCH:
+            save_industry_data(pending, staged=True)
+            pending.clear()
+
+    results, report = fan_out_fetch(
+        industry_list,
+        lambda industry: fetch_industry_history(industry, start_str, end_str),
+        label=f"行业区间数据 {start_str}~{end_str}",
+        on_result=stream_frame if on_rows is not None else None
+    )
+    frames = [frame for frame in results.values() if not frame.empty]
+    if not frames:
+        return pd.DataFrame(columns=["name", "date", "change_percent", "source"]), report
+
+    matrix = pd.concat(frames, ignore_index=True)
+    if on_rows is None:
+        save_industry_data(matrix.to_dict("records"))
+    else:
+        save_industry_data(pending, staged=True)
+        publish_staged_industry(start_str, end_str)
+    return matrix, report
+
+# ==================== 指数历史存储 ====================
+class IndexHistoryStore:
+    """按指数代码保存完整日线序列：本地持久化 + 内存有序数组，增量同步上游
+
+    查询“某日或之前最近的一根K线”与“前收盘价”均为对有序日期数组的二分查找。
+    加锁分两层：同一指数的同步由该指数自己的锁串行（上游拉取期间持有），
+    全局锁只保护内存数组的读取与合并，不跨越网络调用，不同指数的同步可以并行。
+    """
+
+    BAR_COLUMNS = ["open", "close", "high", "low", "volume"]
+
+    def __init__(self):
+        self._dates: Dict[str, List[str]] = {}
+        self._bars: Dict[str, List[Tuple]] = {}
+        self._synced_at: Dict[str, float] = {}
+        self._sync_locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def _sync_lock(self, code: str) -> threading.Lock:
+        with self._lock:
+            return self._sync_locks.setdefault(code, threading.Lock())
+
+    def _load(self, code: str):
+        """首次访问时从数据库加载该指数全部历史（数据库读取不持有全局锁）"""
+        with self._lock:
+            if code in self._dates:
+                return
+        cursor = get_read_conn().execute('''
+            SELECT date, open, close, high, low, volume
+            FROM index_history WHERE code = ? ORDER BY date
+        ''', (code,))
+        rows = cursor.fetchall()
+        with self._lock:
+            if code not in self._dates:
+                self._dates[code] = [row[0] for row in rows]
+                self._bars[code] = [row[1:] for row in rows]
+
+    def _fetch_upstream(self, code: str, last_date: Optional[str]) -> "pd.DataFrame":
+        """拉取晚于 last_date 的K线；last_date 为空时下载全量"""
+        df = None
+        if last_date:
+            try:
+                df = call_upstream(
+                    ak.stock_zh_index_daily_em,
+                    symbol=code,
+                    start_date=last_date.replace("-", ""),
+                    end_date=datetime.now().strftime("%Y%m%d")
+                )
+            except Exception as e:
+                logger.warning(f"指数 {code} 增量接口失败，改为全量下载: {e}")
+        if df is None:
+            df = call_upstream(ak.stock_zh_index_daily, symbol=code)
+        if df.empty:
+            return df
+
+        df = df.copy()
+        df["date"] = pd.to_datetime(df["date"]).dt.strftime("%Y-%m-%d")
+        df[self.BAR_COLUMNS] = df[self.BAR_COLUMNS].astype(float)
+        df = df.sort_values("date")
+        if last_date:
+            df = df[df["date"] > last_date]
+        return df
+
+    def sync(self, code: str, up_to: Optional[str] = None, force: bool = False,
+             refresh_from: Optional[str] = None) -> int:
+        """确保本地序列覆盖到 up_to（默认今天），只拉取缺失的新K线；返回新增/更新条数
+
+        当日K线在盘中会变化，已存在的当日K线在最小同步间隔后重新拉取覆盖；
+        refresh_from 不为空时，不早于该日期的已有K线（盘中写入、收盘后需覆盖）立即重新拉取。
+        """
+        today_str = datetime.now().strftime("%Y-%m-%d")
+        up_to = up_to or today_str
+        with self._sync_lock(code):
+            self._load(code)
+            with self._lock:
+                dates = self._dates[code]
+                bars = self._bars[code]
+                refresh_today = bool(dates) and dates[-1] == today_str and up_to >= today_str
+                refetch = refresh_from is not None and bool(dates) and dates[-1] >= refresh_from
+                if dates and dates[-1] >= up_to and not refresh_today and not refetch and not force:
+                    return 0
+                if (not force and not refetch
+                        and time.monotonic() - self._synced_at.get(code, float("-inf")) < INDEX_SYNC_MIN_INTERVAL):
+                    return 0
+                if refetch:
+                    idx = bisect.bisect_left(dates, refresh_from)
+                    since = dates[idx - 1] if idx > 0 else None
+                elif refresh_today:
+                    since = dates[-2] if len(dates) > 1 else None
+                else:
+                    since = dates[-1] if dates else None
+
+            # 上游拉取与持久化只持有本指数的同步锁；拉取失败不计入同步间隔，下次请求即可重试
+            df = self._fetch_upstream(code, since)
+            self._synced_at[code] = time.monotonic()
+            if df.empty:
+                return 0
+            new_dates = df["date"].tolist()
+            new_bars = list(df[self.BAR_COLUMNS].itertuples(index=False, name=None))
+            write_many('''
+                INSERT OR REPLACE INTO index_history (code, date, open, close, high, low, volume)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', [(code, d) + bar for d, bar in zip(new_dates, new_bars)])
+            with self._lock:
+                # 覆盖与新数据重叠的尾部（盘中更新的当日K线）后追加
+                cut = bisect.bisect_left(dates, new_dates[0])
+                del dates[cut:]
+                del bars[cut:]
+                dates.extend(new_dates)
+                bars.extend(new_bars)
+            logger.info(f"指数 {code} 历史增量同步 {len(new_dates)} 条，最新至 {new_dates[-1]}")
+            return len(new_dates)
+
+    def _archived_bars(self, code: str, start: str, before: Optional[str]) -> List[Tuple[str, Tuple]]:
+        """归档中 [start, before) 内的K线（保留期之外的部分只存在于归档）"""
+        if not is_archived(start):
+            return []
+        rows = read_archive("index_history", start, before or archive_cutoff(), codes=[code])
+        rows.sort(key=lambda row: row["date"])
+        return [(row["date"], tuple(row[col] for col in self.BAR_COLUMNS))
+                for row in rows if before is None or row["date"] < before]
+
+    def bar_on_or_before(self, code: str, date_str: str) -> Optional[Tuple[str, Dict, Optional[float]]]:
+        """返回 (实际日期, K线, 前收盘价)；无数据时返回 None"""
+        self._load(code)
+        with self._lock:
+            dates = self._dates[code]
+            idx = bisect.bisect_right(dates, date_str) - 1
+            if idx > 0:
+                bar = dict(zip(self.BAR_COLUMNS, self._bars[code][idx]))
+                return dates[idx], bar, self._bars[code][idx - 1][1]
+            first = dates[0] if dates else None
+            candidates = [(dates[0], self._bars[code][0])] if idx == 0 else []
+        # 内存序列之前（已归档）的K线
+        since = trading_day_before(date_str, 10) or date_str
+        candidates = [item for item in self._archived_bars(code, since, first) if item[0] <= date_str] + candidates
+        if not candidates:
+            return None
+        day, bar = candidates[-1]
+        prev_close = candidates[-2][1][1] if len(candidates) > 1 else None
+        return day, dict(zip(self.BAR_COLUMNS, bar)), prev_close
+
+    def to_frame(self, code: str, start: Optional[str] = None) -> "pd.DataFrame":
+        """导出序列为 DataFrame（列：date + BAR_COLUMNS）；指定 start 时只导出其前一根K线起的部分"""
+        self._load(code)
+        with self._lock:
+            lo = max(bisect.bisect_left(self._dates[code], start) - 1, 0) if start else 0
+            dates = self._dates[code][lo:]
+            bars = self._bars[code][lo:]
+        if start and (not dates or start <= dates[0]):
+            older = self._archived_bars(code, trading_day_before(start, 1) or start, dates[0] if dates else None)
+            dates = [day for day, _ in older] + dates
+            bars = [bar for _, bar in older] + bars
+        frame = pd.DataFrame(bars, columns=self.BAR_COLUMNS)
+        frame.insert(0, "date", dates)
+        return frame
+
+    def drop_before(self, cutoff_date: str):
+        """丢弃内存中早于 cutoff 的K线（已归档并从数据库删除后调用）"""
+        with self._lock:
+            for code, dates in self._dates.items():
+                cut = bisect.bisect_left(dates, cutoff_date)
+                del dates[:cut]
+                del self._bars[code][:cut]
+
+index_history_store = IndexHistoryStore()
+
+# ==================== 指数数据批量处理 ====================
+def build_index_rows(code: str, name: str, index_df: "pd.DataFrame", start_str: str, end_str: str) -> List[Tuple]:
+    """把指数日线整表按列计算涨跌幅，并一次性转换为 [start, end] 内待入库的元组
+
+    涨跌幅基于前一根K线收盘价（整列错位），首根K线无前收时用当日开盘价。
+    直接在 numpy 数组上计算：区间补齐时每个指数只有几十行，DataFrame 逐列赋值的固定开销占大头。
+    """
+    df = index_df.sort_values("date")
+    dates = pd.to_datetime(df["date"]).dt.strftime("%Y-%m-%d").to_numpy()
+    bars = df[["open", "close", "high", "low", "volume"]].to_numpy(dtype=float)
+
+    open_, close = bars[:, 0], bars[:, 1]
+    prev_close = np.concatenate(([np.nan], close[:-1]))
+    change = np.where(np.isnan(prev_close), (close - open_) / open_ * 100, (close - prev_close) / prev_close * 100)
+    change = np.round(change, 2)
+
+    lo = np.searchsorted(dates, start_str, side="left")
+    hi = np.searchsorted(dates, end_str, side="right")
+    return [(code, name, date, *bar, pct) for date, bar, pct in
+            zip(dates[lo:hi].tolist(), bars[lo:hi].tolist(), change[lo:hi].tolist())]
+
+def save_index_rows(rows: List[Tuple]) -> int:
+    """批量保存指数数据（按 INDEX_COLUMNS 顺序的元组，单事务写入）"""
+    count = write_many(UPSERT_INDEX_SQL, rows)
+    on_data_saved({row[2] for row in rows}, "index")
+    return count
+
+def preload_historical_data() -> Dict:
+    """补齐保留期内缺失的历史数据（启动补齐与收盘后定时刷新共用）
+
+    只拉取缺失或未定型（盘中写入）的交易日；刚定型的最近交易日总是重新拉取覆盖。
+    """
+    logger.info("开始补齐历史数据...")
+    result = {"index_rows": 0, "industry_rows": 0, "index_failed": [], "industry_error": None}
+
+    settled = last_settled_trading_day()
+    if settled is None:
+        logger.warning("交易日历不可用，跳过历史数据补齐")
+        return result
+    start_str = (datetime.now() - timedelta(days=DATA_RETENTION_DAYS)).strftime('%Y-%m-%d')
+    
+    # 指数数据：保留期内缺失或未定型的交易日（各指数并发增量同步，本地计算后批量入库）
+    index_days = trading_days_between(start_str, settled)
+    filled, report = fan_out_fetch(
+        get_index_registry().keys(),
+        lambda code: fill_index_range([code], index_days, refresh=[settled]),
+        label="指数历史补齐"
+    )
+    result["index_rows"] = sum(filled.values())
+    result["index_failed"] = report.failed_keys
+    
+    # 行业数据：最近30天内不完整的交易日（每个行业一次区间调用覆盖所有缺口）
+    industry_start = (datetime.now() - timedelta(days=INDUSTRY_PRELOAD_DAYS - 1)).strftime('%Y-%m-%d')
+    try:
+        result["industry_rows"] = fill_industry_range(trading_days_between(industry_start, settled), refresh=[settled])
+    except Exception as e:
+        result["industry_error"] = str(e)
+        logger.error(f"补齐行业数据失败: {e}")
+    
+    logger.info(f"历史数据补齐完成：指数 {result['index_rows']} 条，行业 {result['industry_rows']} 条")
+    return result
+
+def prune_expired_data() -> int:
+    """把保留期之外的数据移入列式归档（未安装 pyarrow 时直接删除），并清理只覆盖保留期的派生数据
+
+    - index_data / industry_data / index_history / market_summary：按月归档后删除
+    - industry_analytics / index_analytics / analytics_dirty / industry_staging：派生或临时数据，直接删除
+    - trade_calendar 不清理：只有几千行，且日历只向后扩展，删除后更早日期的查询将无法解析交易日
+    """
+    cutoff_date = archive_cutoff()
+    if ARCHIVE_ENABLED:
+        months = archive_expired_data(cutoff_date)
+        # 只删除已成功归档的月份
+        targets = [(table, f"{month}-01", f"{month}-31") for table, month in months]
+    else:
+        targets = [(table, "", cutoff_date) for table in ARCHIVE_COLUMNS]
+    deleted = 0
+    with write_transaction() as conn:
+        for table, month_start, month_end in targets:
+            deleted += conn.execute(
+                f"DELETE FROM {table} WHERE date >= ? AND date <= ? AND date < ?",
+                (month_start, month_end, cutoff_date)
+            ).rowcount
+        for table in ("industry_analytics", "index_analytics", "analytics_dirty", "industry_staging"):
+            deleted += conn.execute(f"DELETE FROM {table} WHERE date < ?", (cutoff_date,)).rowcount
+        conn.execute("DELETE FROM response_cache WHERE expires_at < ?", (time.time(),))
+        history_left = conn.execute("SELECT 1 FROM index_history WHERE date < ? LIMIT 1", (cutoff_date,)).fetchone()
+
+    if not history_left:
+        index_history_store.drop_before(cutoff_date)
+    if deleted:
+        action = "归档" if ARCHIVE_ENABLED else "清理"
+        logger.info(f"已{action} {cutoff_date} 之前的数据 {deleted} 条")
+    return deleted
+
+# ==================== 收盘后定时刷新 ====================
+class RefreshScheduler:
+    """每个交易日收盘后补齐当日数据；启动时先补齐停机期间缺失的交易日，并定期清理过期数据"""
+
+    def __init__(self):
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._last_run_day: Optional[str] = None
+        self.status: Dict[str, Any] = {
+            "running": False,
+            "runs": 0,
+            "last_started": None,
+            "last_finished": None,
+            "last_duration": None,
+            "last_result": None,
+            "last_error": None,
+            "next_run": None
+        }
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="refresh-scheduler", daemon=True)
+            self._thread.start()
+
+    def trigger(self):
+        """立即执行一次刷新"""
+        self._wake.set()
 
-# 配置日志
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-logger = logging.getLogger(__name__)
+    def _due_day(self) -> Optional[str]:
+        """按“收盘时间 + 延迟”计算当前应已刷新到的交易日"""
+        return last_settled_trading_day()
 
-app = FastAPI(
-    title="AkShare API服务",
-    description="为Flutter应用提供股票数据API",
-    version="1.0.0"
-)
+    def _next_run(self, due_day: Optional[str]) -> Optional[str]:
+        upcoming = next_trading_day(due_day) if due_day else None
+        if upcoming is None:
+            return None
+        run_at = datetime.combine(datetime.strptime(upcoming, "%Y-%m-%d").date(), MARKET_CLOSE_TIME)
+        return (run_at + REFRESH_DELAY_AFTER_CLOSE).isoformat(timespec="seconds")
 
-# 配置CORS中间件，允许Flutter应用访问
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # 在生产环境中应该设置具体的域名
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+    def _loop(self):
+        while True:
+            try:
+                due_day = self._due_day()
+                if self._wake.is_set() or due_day != self._last_run_day:
+                    self._wake.clear()
+                    self.run_once()
+                    self._last_run_day = due_day
+                self.status["next_run"] = self._next_run(due_day)
+            except Exception as e:
+                logger.error(f"定时刷新调度异常: {e}")
+            self._wake.wait(SCHEDULER_POLL_SECONDS)
 
-# 全局异常处理
-@app.exception_handler(Exception)
-async def global_exception_handler(request, exc):
-    logger.error(f"全局异常处理: {exc}")
-    return {"code": 500, "message": f"服务器错误: {str(exc)}", "data": []}
+    def run_once(self):
+        started = time.monotonic()
+        self.status["running"] = True
+        self.status["last_started"] = datetime.now().isoformat(timespec="seconds")
+        self.status["last_error"] = None
+        try:
+            refresh_trade_calendar()
+            pruned = prune_expired_data()
+            result = preload_historical_data()
+            result["pruned"] = pruned
+            result["cached_records"] = dict(zip(("index", "industry"), count_cached_records()))
+            self.status["last_result"] = result
+        except Exception as e:
+            self.status["last_error"] = str(e)
+            logger.error(f"定时刷新失败: {e}")
+        finally:
+            self.status["running"] = False
+            self.status["runs"] += 1
+            self.status["last_finished"] = datetime.now().isoformat(timespec="seconds")
+            self.status["last_duration"] = round(time.monotonic() - started, 3)
+            logger.info(f"定时刷新结束，耗时 {self.status['last_duration']}s")
 
-# 请求日志中间件
-@app.middleware("http")
-async def log_requests(request, call_next):
-    start_time = datetime.now()
-    response = await call_next(request)
-    process_time = (datetime.now() - start_time).total_seconds()
-    logger.info(f"{request.method} {request.url.path} - 处理时间: {process_time:.3f}s")
-    return response
+refresh_scheduler = RefreshScheduler()
 
-# 数据库初始化
-def init_database():
-    """初始化数据库表"""
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        
-        # 指数数据表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS index_data (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                code TEXT NOT NULL,
-                name TEXT NOT NULL,
-                date TEXT NOT NULL,
-                open REAL,
-                close REAL,
-                high REAL,
-                low REAL,
-                volume REAL,
-                change_percent REAL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(code, date)
-            )
-        ''')
-        
-        # 行业数据表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS industry_data (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                date TEXT NOT NULL,
-                change_percent REAL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(name, date)
-            )
-        ''')
-        
-        # 清理过期数据（保留半年）
-        cutoff_date = (datetime.now() - timedelta(days=DATA_RETENTION_DAYS)).strftime('%Y-%m-%d')
-        cursor.execute("DELETE FROM index_data WHERE date < ?", (cutoff_date,))
-        cursor.execute("DELETE FROM industry_data WHERE date < ?", (cutoff_date,))
-        
-        conn.commit()
-        logger.info("数据库初始化完成")
+# ==================== 多进程选主 ====================
+class LeaderElection:
+    """多 worker 部署时用数据库旁的文件锁选出唯一 leader，只有 leader 运行预加载与定时刷新
 
-def get_cached_index_data(code: str, target_date: str) -> Optional[Dict]:
-    """从缓存获取指数数据"""
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT code, name, date, open, close, high, low, volume, change_percent
-            FROM index_data 
-            WHERE code = ? AND date = ?
-        ''', (code, target_date))
-        row = cursor.fetchone()
-        
-        if row:
-            return {
-                "code": row[0],
-                "name": row[1],
-                "date": row[2],
-                "open": row[3],
-                "close": row[4],
-                "high": row[5],
-                "low": row[6],
-                "volume": row[7],
-                "change_percent": row[8]
-            }
-    return None
+    leader 进程退出后操作系统自动释放文件锁，其他 worker 定期重试并接管。
+    """
 
-def save_index_data(data: Dict):
-    """保存指数数据到数据库"""
-    with lock:
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT OR REPLACE INTO index_data 
-                (code, name, date, open, close, high, low, volume, change_percent)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                data['code'], data['name'], data['date'],
-                data['open'], data['close'], data['high'], 
-                data['low'], data['volume'], data['change_percent']
-            ))
-            conn.commit()
+    def __init__(self):
+        self.is_leader = False
+        self.elected_at: Optional[str] = None
+        self._lock_file = None
+        self._on_elected: Optional[Callable[[], None]] = None
 
-def get_cached_industry_data(target_date: str) -> List[Dict]:
-    """从缓存获取行业数据"""
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT name, change_percent, date
-            FROM industry_data 
-            WHERE date = ?
-            ORDER BY change_percent DESC
-        ''', (target_date,))
-        
-        return [{
-            "name": row[0],
-            "change_percent": row[1],
-            "date": row[2]
-        } for row in cursor.fetchall()]
-
-def save_industry_data(data_list: List[Dict]):
-    """保存行业数据到数据库"""
-    with lock:
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            for data in data_list:
-                cursor.execute('''
-                    INSERT OR REPLACE INTO industry_data 
-                    (name, date, change_percent)
-                    VALUES (?, ?, ?)
-                ''', (data['name'], data['date'], data['change_percent']))
-            conn.commit()
+    @property
+    def lock_path(self) -> str:
+        return DB_PATH + ".leader"
 
-def preload_historical_data():
-    """预加载过去半年的历史数据（后台任务）"""
-    logger.info("开始预加载历史数据...")
-    
-    try:
-        # 计算过去半年的日期范围
-        end_date = datetime.now()
-        start_date = end_date - timedelta(days=DATA_RETENTION_DAYS)
-        
-        # 预加载指数数据
-        for code, name in MAJOR_INDEXES.items():
+    def try_acquire(self) -> bool:
+        if self.is_leader:
+            return True
+        if fcntl is not None:
+            lock_file = open(self.lock_path, "a+")
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            lock_file.seek(0)
+            lock_file.truncate()
+            lock_file.write(str(os.getpid()))
+            lock_file.flush()
+            self._lock_file = lock_file  # 持有文件句柄即持有锁
+        self.is_leader = True
+        self.elected_at = datetime.now().isoformat(timespec="seconds")
+        logger.info(f"进程 {os.getpid()} 成为 leader，负责预加载与定时刷新")
+        if self._on_elected is not None:
+            self._on_elected()
+        return True
+
+    def start(self, on_elected: Callable[[], None]):
+        """立即参与选主；未当选时在后台线程中定期重试"""
+        self._on_elected = on_elected
+        if self.try_acquire():
+            return
+        logger.info(f"进程 {os.getpid()} 为 follower，只提供查询服务")
+        threading.Thread(target=self._retry_loop, name="leader-election", daemon=True).start()
+
+    def _retry_loop(self):
+        while not self.is_leader:
+            time.sleep(LEADER_RETRY_SECONDS)
             try:
-                logger.info(f"正在预加载指数数据: {name}")
-                index_df = ak.stock_zh_index_daily(symbol=code)
-                index_df["date"] = pd.to_datetime(index_df["date"])
-                
-                # 筛选半年的数据
-                mask = (index_df["date"] >= start_date.strftime('%Y-%m-%d')) & \
-                       (index_df["date"] <= end_date.strftime('%Y-%m-%d'))
-                recent_data = index_df[mask]
-                
-                for _, row in recent_data.iterrows():
-                    date_str = row["date"].strftime('%Y-%m-%d')
-                    
-                    # 计算涨跌幅
-                    current_idx = row.name
-                    if current_idx > 0:
-                        prev_close = float(index_df.iloc[current_idx - 1]["close"])
-                        change_percent = round((row["close"] - prev_close) / prev_close * 100, 2)
-                    else:
-                        change_percent = round((row["close"] - row["open"]) / row["open"] * 100, 2)
-                    
-                    data = {
-                        "code": code,
-                        "name": name,
-                        "date": date_str,
-                        "open": float(row["open"]),
-                        "close": float(row["close"]),
-                        "high": float(row["high"]),
-                        "low": float(row["low"]),
-                        "volume": float(row["volume"]),
-                        "change_percent": change_percent
-                    }
-                    save_index_data(data)
-                
-                logger.info(f"指数 {name} 数据预加载完成，共 {len(recent_data)} 条")
-                
+                self.try_acquire()
             except Exception as e:
-                logger.error(f"预加载指数 {name} 数据失败: {e}")
-                continue
-        
-        # 预加载行业数据（只预加载最近30天，因为历史行业数据获取较慢）
-                # 预加载行业数据（最近30个交易日）
-        try:
-            # 先获取当前所有行业名称
-            industry_summary = ak.stock_board_industry_summary_ths()
-            if industry_summary.empty:
-                logger.warning("无法获取行业板块列表，跳过行业数据预加载")
-            else:
-                industry_list = industry_summary["板块"].tolist()
-                logger.info(f"获取到 {len(industry_list)} 个行业板块，开始预加载最近30个交易日数据")
-
-                loaded_dates = set()
-                for i in range(30):  # 尝试最近30天
-                    candidate_date = datetime.now() - timedelta(days=i)
-                    date_str_no_dash = candidate_date.strftime("%Y%m%d")
-                    date_str_dash = candidate_date.strftime("%Y-%m-%d")
-
-                    # 检查该日期是否有交易数据（用“银行”板块作为探测）
-                    probe_df = ak.stock_board_industry_index_ths(symbol="银行", start_date=date_str_no_dash, end_date=date_str_no_dash)
-                    if probe_df.empty:
-                        continue  # 非交易日，跳过
-
-                    # 找到前一个交易日（作为计算涨跌幅的基准）
-                    prev_date = candidate_date
-                    prev_date_str_no_dash = date_str_no_dash
-                    for j in range(1, 10):  # 最多往前找9天
-                        prev_date = candidate_date - timedelta(days=j)
-                        prev_date_str_no_dash = prev_date.strftime("%Y%m%d")
-                        prev_probe = ak.stock_board_industry_index_ths(symbol="银行", start_date=prev_date_str_no_dash, end_date=prev_date_str_no_dash)
-                        if not prev_probe.empty:
-                            break
-                    else:
-                        logger.warning(f"找不到 {date_str_dash} 的前一交易日，跳过该日行业数据")
-                        continue
+                logger.error(f"选主失败: {e}")
 
-                    # 收集该交易日所有行业涨跌幅
-                    daily_sectors = []
-                    for industry in industry_list:
-                        try:
-                            today_df = ak.stock_board_industry_index_ths(symbol=industry, start_date=date_str_no_dash, end_date=date_str_no_dash)
-                            yesterday_df = ak.stock_board_industry_index_ths(symbol=industry, start_date=prev_date_str_no_dash, end_date=prev_date_str_no_dash)
-
-                            if not today_df.empty and not yesterday_df.empty:
-                                today_close = float(today_df["收盘价"].iloc[0])
-                                yesterday_close = float(yesterday_df["收盘价"].iloc[0])
-                                change_percent = round((today_close - yesterday_close) / yesterday_close * 100, 2)
-                                daily_sectors.append({
-                                    "name": industry,
-                                    "change_percent": change_percent,
-                                    "date": date_str_dash
-                                })
-                        except Exception as e:
-                            logger.debug(f"预加载行业 {industry} {date_str_dash} 数据失败: {e}")
-                            continue
-
-                    if daily_sectors:
-                        save_industry_data(daily_sectors)
-                        loaded_dates.add(date_str_dash)
-                        logger.info(f"预加载行业数据完成: {date_str_dash}，共 {len(daily_sectors)} 个板块")
-
-                logger.info(f"行业历史数据预加载完成，共加载 {len(loaded_dates)} 个交易日")
+    def stats(self) -> Dict:
+        return {"pid": os.getpid(), "is_leader": self.is_leader, "elected_at": self.elected_at}
+
+leader_election = LeaderElection()
+
+def start_leader_jobs():
+    """leader 专属的后台任务：补齐缺失数据、收盘后刷新、回填市场概览、重算分析指标"""
+    refresh_scheduler.start()
+    analytics_refresher.start()
+    threading.Thread(target=backfill_market_summaries, daemon=True).start()
+    threading.Thread(target=backfill_analytics, daemon=True).start()
+
+def count_cached_records() -> Tuple[int, int]:
+    """统计已缓存的指数/行业记录数"""
+    conn = get_read_conn()
+    index_count = conn.execute("SELECT COUNT(*) FROM index_data").fetchone()[0]
+    industry_count = conn.execute("SELECT COUNT(*) FROM industry_data").fetchone()[0]
+    return index_count, industry_count
+
+# ==================== 启动预热 ====================
+class Warmup:
+    """服务启动后在后台依次完成的预热步骤，/ready 在全部完成前返回503"""
+
+    def __init__(self):
+        self.started_at: Optional[str] = None
+        self.durations: Dict[str, Optional[float]] = {
+            "schema": None, "registry": None, "imports": None, "calendar": None
+        }
+        self.errors: Dict[str, str] = {}  # 阶段 -> 最近一次失败原因（重试成功后清除）
+        self.schema_ready = threading.Event()
+
+    @property
+    def ready(self) -> bool:
+        return not self.errors and all(v is not None for v in self.durations.values())
+
+    def status(self) -> Dict:
+        return {
+            "ready": self.ready,
+            "started_at": self.started_at,
+            "stages": {k: ("done" if v is not None else "failed" if k in self.errors else "pending")
+                       for k, v in self.durations.items()},
+            "durations": self.durations,
+            "error": "; ".join(f"{k}: {v}" for k, v in self.errors.items()) or None,
+        }
+
+warmup = Warmup()
+
+def import_heavy_modules():
+    """提前导入 pandas / akshare，避免第一个冷请求承担导入耗时"""
+    pd.load()
+    ak.load()
+
+def load_trade_calendar_until_ready():
+    """加载交易日历；首次启动且上游不可用时日历为空，按日历的退避间隔重试直至成功（期间 /ready 保持503）"""
+    while True:
+        refresh_trade_calendar()
+        if _trade_days:
+            warmup.errors.pop("calendar", None)
+            return
+        warmup.errors["calendar"] = "交易日历为空，等待上游恢复后重试"
+        time.sleep(max(_trade_calendar_retry_at - time.monotonic(), 1.0))
+
+def run_warmup():
+    """后台预热：建表 -> 加载注册表 -> 导入重量级依赖 -> 加载交易日历，之后参与选主"""
+    steps = [
+        ("schema", init_database),
+        ("registry", load_index_registry),
+        ("imports", import_heavy_modules),
+        ("calendar", load_trade_calendar_until_ready),  # 首次启动时从上游批量拉取一次
+    ]
+    for stage, fn in steps:
+        started = time.perf_counter()
+        try:
+            fn()
         except Exception as e:
-            logger.error(f"预加载行业数据整体失败: {e}")
-        
-        logger.info("历史数据预加载完成")
-        
-    except Exception as e:
-        logger.error(f"预加载历史数据失败: {e}")
+            warmup.errors[stage] = str(e)
+            logger.error(f"启动预热失败（{stage}）: {e}")
+            if stage == "schema":
+                return
+            continue
+        warmup.durations[stage] = round(time.perf_counter() - started, 3)
+        if stage == "schema":
+            warmup.schema_ready.set()
+    logger.info(f"启动预热完成: {warmup.durations}")
+    # 多 worker 时只有 leader 在后台补齐停机期间缺失的交易日，之后每个交易日收盘后增量刷新
+    leader_election.start(on_elected=start_leader_jobs)
+
+async def wait_for_schema():
+    """建表完成前到达的数据请求短暂等待（建表通常只需几毫秒）"""
+    if not warmup.schema_ready.is_set():
+        if not await run_db(warmup.schema_ready.wait, WARMUP_SCHEMA_WAIT):
+            raise HTTPException(status_code=503, detail="服务预热中，请稍后重试")
 
-# 在应用启动时初始化数据库和预加载数据
+# 应用启动时只登记后台任务，不做任何阻塞操作，监听端口后即可响应
 @app.on_event("startup")
 async def startup_event():
     """应用启动时的初始化"""
     logger.info("正在启动AkShare API服务...")
-    init_database()
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM index_data")
-        index_count = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM industry_data")
-        industry_count = cursor.fetchone()[0]
-    # 在后台线程预加载历史数据
-    total_records = index_count + industry_count
-    if total_records < 100:  # 可以根据实际情况调整阈值，比如 < 500
-        logger.info(f"数据库记录较少（{total_records}条），开始完整预加载历史数据...")
-        threading.Thread(target=preload_historical_data, daemon=True).start()
-    else:
-        logger.info(f"数据库已有 {total_records} 条记录，跳过完整预加载（仅依赖缓存+按需拉取）")
+    warmup.started_at = datetime.now().isoformat(timespec="seconds")
+    asyncio.ensure_future(monitor_event_loop_lag())
+    threading.Thread(target=run_warmup, name="warmup", daemon=True).start()
 
 
 # 健康检查端点
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "message": "AkShare服务运行正常"}
+    return {
+        "status": "healthy",
+        "message": "AkShare服务运行正常",
+        "single_flight": live_fetch_flight.stats(),
+        "upstream_breaker": upstream_breaker.stats(),
+        "hot_cache": hot_cache.stats(),
+        "worker": leader_election.stats()
+    }
+
+def collect_component_metrics():
+    """把各组件的内部统计转成 gauge（/metrics 渲染前调用）"""
+    for key, value in hot_cache.stats().items():
+        if value is not None:
+            metrics.set(f"hot_cache_{key}", "进程内热数据层统计", value)
+    breaker = upstream_breaker.stats()
+    for state in ("closed", "open", "half_open"):
+        metrics.set("upstream_breaker_state", "上游熔断器状态（当前状态为1）", int(breaker["state"] == state), state=state)
+    metrics.set("upstream_breaker_rejected", "熔断期间被拒绝的上游调用数", breaker["rejected"])
+    for key, value in live_fetch_flight.stats().items():
+        metrics.set(f"single_flight_{key}", "单飞请求合并统计", value)
+    status = refresh_scheduler.status
+    metrics.set("refresh_running", "定时刷新/预加载是否正在运行", int(bool(status["running"])))
+    metrics.set("refresh_runs", "定时刷新已完成次数", status["runs"])
+    if status["last_duration"] is not None:
+        metrics.set("refresh_last_duration_seconds", "最近一次定时刷新耗时（秒）", status["last_duration"])
+    for key in ("index_rows", "industry_rows"):
+        if status["last_result"] and key in status["last_result"]:
+            metrics.set("refresh_last_rows", "最近一次定时刷新补齐的记录数", status["last_result"][key], kind=key)
+    metrics.set("worker_is_leader", "当前 worker 是否为 leader", int(leader_election.is_leader))
+
+metrics.add_collector(collect_component_metrics)
+
+@app.get("/ready")
+async def readiness_check():
+    """就绪探针：建表、注册表、依赖导入和交易日历全部完成后返回200，否则503（/health 只表示进程存活）"""
+    status = warmup.status()
+    if not warmup.ready:
+        return JSONResponse(status_code=503, content={"code": 503, "message": "服务预热中", "data": status})
+    return {"code": 200, "message": "ready", "data": status}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus 文本格式指标（本 worker 进程）"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/metrics/profiles")
+async def get_profiles():
+    """最近的请求级采样分析结果（需设置环境变量 API_PROFILING=1，并在请求中带 _profile=1）"""
+    return {"code": 200, "message": "success", "enabled": PROFILING_ENABLED, "data": list(recent_profiles)}
 
 # 定义主要指数：代码 -> 名称（可扩展）
 MAJOR_INDEXES = {
@@ -317,12 +2485,213 @@ MAJOR_INDEXES = {
     "sh000300": "沪深300"  # 可根据需要添加
 }
 
+# ==================== 指数代码注册表 ====================
+MAX_INDEX_CODES_PER_REQUEST = 500  # 单次请求最多的代码数（受 SQLite 参数个数限制）
+
+_index_registry: Dict[str, Dict] = {}  # code -> {"name": 名称, "is_major": 是否主要指数}
+_index_registry_loaded_at = 0.0
+_index_registry_lock = threading.Lock()
+
+def load_index_registry() -> Dict[str, Dict]:
+    """从数据库重新加载已启用的指数代码"""
+    global _index_registry, _index_registry_loaded_at
+    cursor = get_read_conn().execute(
+        "SELECT code, name, is_major FROM index_registry WHERE enabled = 1 ORDER BY is_major DESC, rowid"
+    )
+    with _index_registry_lock:
+        _index_registry = {row[0]: {"name": row[1], "is_major": bool(row[2])} for row in cursor.fetchall()}
+        _index_registry_loaded_at = time.monotonic()
+    return _index_registry
+
+def get_index_registry() -> Dict[str, Dict]:
+    """已启用的指数代码（内存缓存，本进程变更时立即、其他进程变更后定期重新加载）"""
+    if not _index_registry or time.monotonic() - _index_registry_loaded_at > REGISTRY_RELOAD_SECONDS:
+        return load_index_registry()
+    return _index_registry
+
+def index_name(code: str) -> str:
+    entry = get_index_registry().get(code)
+    return entry["name"] if entry else MAJOR_INDEXES.get(code, code)
+
+def major_index_codes() -> List[str]:
+    codes = [code for code, entry in get_index_registry().items() if entry["is_major"]]
+    return codes or list(MAJOR_INDEXES.keys())
+
+def resolve_index_codes(codes_param: Optional[str]) -> List[str]:
+    """解析 codes 查询参数：为空时返回主要指数；未注册的代码返回400"""
+    if not codes_param:
+        return major_index_codes()
+    codes = list(dict.fromkeys(c.strip() for c in codes_param.split(",") if c.strip()))
+    if len(codes) > MAX_INDEX_CODES_PER_REQUEST:
+        raise HTTPException(status_code=400, detail=f"单次最多查询 {MAX_INDEX_CODES_PER_REQUEST} 个代码")
+    registry = get_index_registry()
+    unknown = [c for c in codes if c not in registry]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"未注册的代码: {','.join(unknown[:20])}")
+    return codes
+
+def _refresh_summaries_with(code: str):
+    """主要指数集合变化后，重算该代码已有数据的交易日的市场概览"""
+    cursor = get_read_conn().execute("SELECT date FROM index_data WHERE code = ?", (code,))
+    dates = [row[0] for row in cursor.fetchall()]
+    if dates:
+        refresh_market_summaries(dates)
+        hot_cache.invalidate(dates)
+        invalidate_shared_responses(dates)
+
+def register_index_symbol(code: str, name: str, is_major: bool = False):
+    """注册（或重新启用）一个指数/ETF 代码"""
+    was_major = get_index_registry().get(code, {}).get("is_major", False)
+    write_many('''
+        INSERT INTO index_registry (code, name, is_major, enabled) VALUES (?, ?, ?, 1)
+        ON CONFLICT(code) DO UPDATE SET name = excluded.name, is_major = excluded.is_major, enabled = 1
+    ''', [(code, name, int(is_major))])
+    load_index_registry()
+    if was_major != is_major:
+        _refresh_summaries_with(code)
+
+def disable_index_symbol(code: str) -> bool:
+    """停用一个代码（保留历史数据）"""
+    entry = get_index_registry().get(code)
+    if entry is None:
+        return False
+    write_many("UPDATE index_registry SET enabled = 0 WHERE code = ?", [(code,)])
+    load_index_registry()
+    if entry["is_major"]:
+        _refresh_summaries_with(code)
+    return True
+
+def fetch_index_live(code: str, name: str, trading_day_str: str) -> Optional[Dict]:
+    """缓存未命中时从本地指数历史（必要时增量同步上游）取数，计算涨跌幅并写入缓存（阻塞调用）
+
+    同步间隔内未拉取到新K线且缓存内容不变时不重复写入：保留原写入时间，旧数据不会被当作新鲜数据。
+    """
+    synced = index_history_store.sync(code, up_to=trading_day_str)
+    found = index_history_store.bar_on_or_before(code, trading_day_str)
+    if found is None:
+        logger.warning(f"指数 {name} 无任何历史数据")
+        return None
+
+    actual_date_str, bar, prev_close = found
+    # 当日数据尚未产出时最多回退10个交易日
+    if len(trading_days_between(actual_date_str, trading_day_str)) > 10:
+        logger.warning(f"指数 {name} 在目标日期附近10天内无数据")
+        return None
+
+    open_val, close_val = bar["open"], bar["close"]
+    if prev_close:
+        change_percent = round((close_val - prev_close) / prev_close * 100, 2)
+    else:
+        change_percent = round((close_val - open_val) / open_val * 100, 2) if open_val != 0 else 0
+
+    data = {
+        "name": name,
+        "code": code,
+        "open": open_val,
+        "close": close_val,
+        "high": bar["high"],
+        "low": bar["low"],
+        "volume": bar["volume"],
+        "change_percent": change_percent,
+        "date": actual_date_str
+    }
+    if synced or get_cached_index_data(code, actual_date_str) != data:
+        save_index_data(data)
+    return data
+
+def fetch_index_batch_live(codes: List[str], trading_day_str: str) -> Dict[str, Dict]:
+    """并发拉取多个指数在某交易日的数据并写入缓存（阻塞调用），返回 code -> 数据"""
+    results, _ = fan_out_fetch(
+        codes,
+        lambda code: fetch_index_live(code, index_name(code), trading_day_str),
+        label=f"指数实时补齐 {trading_day_str}"
+    )
+    return {code: data for code, data in results.items() if data}
+
+# 当日行业快照来源（按顺序尝试）：(接口, 参数, 名称列, 涨跌幅列, 来源标记)
+# 新浪行业分类与同花顺不同，其快照只作临时响应，不入库（否则与其他日期的同花顺名称混在一起）
+INDUSTRY_SPOT_SOURCES = [
+    ("stock_board_industry_summary_ths", {}, "板块", "涨跌幅", SOURCE_THS_SUMMARY),
+    ("stock_sector_spot", {"indicator": "新浪行业"}, "板块", "涨跌幅", SOURCE_SINA_SPOT),
+]
+PERSISTED_SPOT_SOURCES = {SOURCE_THS_SUMMARY}
+
+def fetch_industry_spot(date_str: str) -> List[Dict]:
+    """一次上游调用获取当日全部行业涨跌幅快照，并统一为 name/change_percent/date/source"""
+    for func_name, kwargs, name_col, change_col, source in INDUSTRY_SPOT_SOURCES:
+        try:
+            df = call_upstream(getattr(ak, func_name), **kwargs)
+            if df.empty or name_col not in df.columns or change_col not in df.columns:
+                logger.warning(f"行业快照 {func_name} 返回数据缺少所需列")
+                continue
+            frame = pd.DataFrame({
+                "name": df[name_col].astype(str).str.strip(),
+                "change_percent": pd.to_numeric(df[change_col], errors="coerce").round(2)
+            }).dropna(subset=["change_percent"]).drop_duplicates(subset=["name"])
+            if frame.empty:
+                continue
+            frame["date"] = date_str
+            frame["source"] = source
+            return frame.to_dict("records")
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            logger.warning(f"行业快照 {func_name} 获取失败: {e}")
+    return []
+
+def fetch_industry_live(
+    actual_date_str: str,
+    on_rows: Optional[Callable[[List[Dict]], None]] = None
+) -> Tuple[List[Dict], Optional[FetchReport]]:
+    """缓存未命中时从上游拉取某交易日所有行业涨跌幅并写入缓存（阻塞调用）
+
+    当日优先用一次快照调用覆盖全部行业；历史日期或快照失败时逐行业区间拉取。
+    只有新浪快照可用时也先尝试逐行业拉取（同花顺分类），仍失败才把新浪快照作为临时结果返回（不入库）。
+    on_rows 不为空时，已算出的记录会在拉取过程中分批回调（供流式接口推送）。
+    """
+    def spot_result(spot: List[Dict]) -> Tuple[List[Dict], None]:
+        if on_rows is not None:
+            on_rows(spot)
+        spot.sort(key=lambda x: x["change_percent"], reverse=True)
+        return [{k: d[k] for k in ("name", "change_percent", "date")} for d in spot], None
+
+    transient: List[Dict] = []
+    if actual_date_str == datetime.now().strftime("%Y-%m-%d"):
+        spot = fetch_industry_spot(actual_date_str)
+        if spot and spot[0]["source"] in PERSISTED_SPOT_SOURCES:
+            save_industry_data(spot)
+            return spot_result(spot)
+        transient = spot
+        logger.warning("当日同花顺行业快照不可用，改为逐行业拉取")
+
+    try:
+        # 获取行业列表（一次就好）
+        summary_df = call_upstream(ak.stock_board_industry_summary_ths)
+        if summary_df.empty:
+            raise ValueError("无法获取行业板块列表")
+        industry_list = summary_df["板块"].tolist()
+
+        # 计算所有行业涨跌幅（每个行业一次区间调用，含前一交易日基准），并整体入库
+        matrix, report = load_industry_history(industry_list, actual_date_str, actual_date_str, on_rows=on_rows)
+    except Exception as e:
+        if not transient:
+            raise
+        logger.warning(f"逐行业拉取失败，临时返回新浪行业快照（不入库）: {e}")
+        return spot_result(transient)
+    if matrix.empty and transient:
+        logger.warning("逐行业拉取无结果，临时返回新浪行业快照（不入库）")
+        return spot_result(transient)
+    sectors = matrix.sort_values("change_percent", ascending=False)[["name", "change_percent", "date"]].to_dict("records")
+    return sectors, report
+
 
 @app.get("/api/index")
 async def get_index_data(
-    date: str = Query(None, description="日期格式：YYYYMMDD，不提供则获取最新交易日数据")
+    response: Response,
+    date: str = Query(None, description="日期格式：YYYYMMDD，不提供则获取最新交易日数据"),
+    codes: Optional[str] = Query(None, description="逗号分隔的已注册代码，不提供则返回主要指数")
 ):
-    """获取主要指数数据（新增缓存支持）"""
+    """获取指数数据（新增缓存支持，codes 可指定注册表中的任意代码；部分代码获取失败时标记为不可缓存）"""
     try:
         # 处理目标日期
         if date is None:
@@ -334,119 +2703,89 @@ async def get_index_data(
                 raise HTTPException(status_code=400, detail="日期格式错误，请使用YYYYMMDD（如20231009）")
         
         target_date_str = target_date.strftime("%Y-%m-%d")
-        logger.info(f"开始获取指数数据（目标日期：{target_date_str}）")
-        
-        result = []
-        actual_date_str = None  # 实际使用的交易日
-
-        for code, name in MAJOR_INDEXES.items():
-            try:
-                # Step 1: 优先尝试从缓存读取（先用目标日期）
-                cached = get_cached_index_data(code, target_date_str)
-                if cached:
-                    result.append({
-                        "name": cached["name"],
-                        "code": cached["code"],
-                        "open": cached["open"],
-                        "close": cached["close"],
-                        "high": cached["high"],
-                        "low": cached["low"],
-                        "volume": cached["volume"],
-                        "change_percent": cached["change_percent"],
-                        "date": cached["date"]
-                    })
-                    actual_date_str = cached["date"]
-                    continue
+        code_list = await run_db(resolve_index_codes, codes)
+        # 通过交易日历解析实际交易日（无需访问上游）
+        trading_day_str = await run_db(resolve_trading_day, target_date) or target_date_str
+        logger.info(f"开始获取指数数据（目标日期：{target_date_str}，交易日：{trading_day_str}，代码数：{len(code_list)}）")
 
-                # Step 2: 缓存未命中，实时获取全量数据
-                index_df = ak.stock_zh_index_daily(symbol=code)
-                if index_df.empty:
-                    logger.warning(f"指数 {name} 无任何历史数据")
-                    continue
+        # 缓存未命中或已过期时的批量拉取（同一批代码同一交易日的并发请求合并）
+        def load_indexes(batch: List[str]):
+            async def load():
+                # 合并窗口外刚完成的拉取可能已写入缓存，先复查一次
+                rechecked = await run_db(get_cached_index_batch, batch, trading_day_str)
+                found = {c: d for c, (d, age) in rechecked.items() if is_fresh("index", trading_day_str, age)}
+                missing = [c for c in batch if c not in found]
+                if missing:
+                    found.update(await run_upstream(fetch_index_batch_live, missing, trading_day_str))
+                return found
+            return load
 
-                index_df["date"] = pd.to_datetime(index_df["date"])
-                index_df["date_str"] = index_df["date"].dt.strftime("%Y-%m-%d")
-
-                # 回溯找到最近交易日
-                query_date = target_date
-                data_row = None
-                for back in range(10):
-                    q_str = query_date.strftime("%Y-%m-%d")
-                    matched = index_df[index_df["date_str"] == q_str]
-                    if not matched.empty:
-                        data_row = matched.iloc[0]
-                        actual_date_str = q_str
-                        break
-                    query_date -= timedelta(days=1)
-                
-                if data_row is None:
-                    logger.warning(f"指数 {name} 在目标日期附近10天内无数据")
-                    continue
+        # Step 1: 一次查询读取所有代码的缓存（用解析后的交易日）
+        cached = await run_db(get_cached_index_batch, code_list, trading_day_str)
+        found: Dict[str, Tuple[Dict, str]] = {
+            code: (data, "cache") for code, (data, age) in cached.items()
+            if is_fresh("index", trading_day_str, age)
+        }
+        pending = [code for code in code_list if code not in found]
 
-                # 提取数据
-                open_val = float(data_row["open"])
-                close_val = float(data_row["close"])
-                high_val = float(data_row["high"])
-                low_val = float(data_row["low"])
-                volume_val = float(data_row["volume"])
-
-                # 计算涨跌幅：找前一交易日收盘价
-                prev_close = None
-                prev_query = query_date - timedelta(days=1)
-                for _ in range(10):
-                    prev_str = prev_query.strftime("%Y-%m-%d")
-                    prev_row = index_df[index_df["date_str"] == prev_str]
-                    if not prev_row.empty:
-                        prev_close = float(prev_row.iloc[0]["close"])
-                        break
-                    prev_query -= timedelta(days=1)
-
-                if prev_close:
-                    change_percent = round((close_val - prev_close) / prev_close * 100, 2)
-                else:
-                    change_percent = round((close_val - open_val) / open_val * 100, 2) if open_val != 0 else 0
-
-                # 组装数据
-                data = {
-                    "name": name,
-                    "code": code,
-                    "open": open_val,
-                    "close": close_val,
-                    "high": high_val,
-                    "low": low_val,
-                    "volume": volume_val,
-                    "change_percent": change_percent,
-                    "date": actual_date_str
-                }
-                result.append(data)
-
-                # Step 3: 保存到缓存
-                save_index_data({
-                    "code": code,
-                    "name": name,
-                    "date": actual_date_str,
-                    "open": open_val,
-                    "close": close_val,
-                    "high": high_val,
-                    "low": low_val,
-                    "volume": volume_val,
-                    "change_percent": change_percent
-                })
+        if pending and trading_day_str == datetime.now().strftime("%Y-%m-%d"):
+            # Step 2: 当日数据过期或缺失时先返回最近快照，后台批量刷新
+            snapshots = {code: cached[code][0] for code in pending if code in cached}
+            without = [code for code in pending if code not in snapshots]
+            if without:
+                snapshots.update(await run_db(get_latest_cached_index_batch, without, trading_day_str))
+            if snapshots:
+                batch = [code for code in pending if code in snapshots]
+                refresh_in_background(("index", trading_day_str, tuple(batch)), load_indexes(batch))
+                found.update({code: (data, "stale") for code, data in snapshots.items()})
+            pending = [code for code in pending if code not in snapshots]
 
+        if pending:
+            # Step 3: 无可用快照的代码在上游线程池中并发获取并保存
+            try:
+                fetched = await live_fetch_flight.do(("index", trading_day_str, tuple(pending)), load_indexes(pending))
+                found.update({code: (data, "live") for code, data in fetched.items()})
             except Exception as e:
-                logger.error(f"获取指数[{name}]数据失败：{str(e)}")
+                logger.error(f"批量获取指数数据失败：{str(e)}")
+
+        result = []
+        actual_date_str = None  # 实际使用的交易日
+        sources = set()
+        for code in code_list:
+            if code not in found:
                 continue
+            data, source = found[code]
+            result.append({
+                "name": data["name"],
+                "code": data["code"],
+                "open": data["open"],
+                "close": data["close"],
+                "high": data["high"],
+                "low": data["low"],
+                "volume": data["volume"],
+                "change_percent": data["change_percent"],
+                "date": data["date"]
+            })
+            actual_date_str = data["date"]
+            sources.add(source)
 
         if not result:
+            if upstream_breaker.state != "closed":
+                raise HTTPException(status_code=503, detail="上游数据源暂不可用，请稍后重试")
             raise HTTPException(status_code=500, detail="所有指数数据获取失败")
 
         resp = {
             "code": 200,
             "message": "success",
-            "data": result
+            "data": result,
+            "data_source": next(src for src in ("stale", "live", "cache") if src in sources)
         }
         if actual_date_str and actual_date_str != target_date_str:
             resp["note"] = f"请求日期{target_date_str}无数据，已返回最近交易日{actual_date_str}"
+        failed_codes = [code for code in code_list if code not in found]
+        if failed_codes:
+            resp["failed_codes"] = failed_codes
+            response.headers["Cache-Control"] = DEGRADED_CACHE_CONTROL
 
         logger.info(f"指数数据返回：{len(result)}条")
         return resp
@@ -459,106 +2798,70 @@ async def get_index_data(
 
 
 @app.get("/api/industry")
-async def get_industry_data(date: str = None):
+async def get_industry_data(response: Response, date: str = None):
     """
-    获取行业板块数据（支持历史日期 + 有效缓存）
+    获取行业板块数据（支持历史日期 + 有效缓存；部分行业拉取失败时标记为不可缓存）
     """
     try:
         # 处理目标日期
         if date is None:
             target_date = datetime.now()
             target_date_str = target_date.strftime('%Y-%m-%d')
-            date_no_dash = target_date.strftime("%Y%m%d")
         else:
             target_date = datetime.strptime(date, "%Y%m%d")
             target_date_str = target_date.strftime('%Y-%m-%d')
-            date_no_dash = date
 
         if target_date.date() > datetime.now().date():
             return {"code": 400, "message": "不能查询未来日期", "data": []}
 
         logger.info(f"请求行业数据: {target_date_str}")
 
-        # 1. 先查缓存（直接用请求的target_date_str）
-        cached_data = get_cached_industry_data(target_date_str)
-        if cached_data:
-            logger.info(f"✅ 缓存命中: {target_date_str}，共{len(cached_data)}条")
-            return {"code": 200, "message": "success", "data": cached_data, "data_source": "cache"}
-
-        # 2. 缓存未命中，实时获取
-        logger.info(f"❌ 缓存未命中，实时拉取 {target_date_str}")
-
-        # 获取行业列表（一次就好）
-        summary_df = ak.stock_board_industry_summary_ths()
-        if summary_df.empty:
-            raise ValueError("无法获取行业板块列表")
-        industry_list = summary_df["板块"].tolist()
+        # 通过交易日历解析实际交易日（无需访问上游）
+        actual_date_str = await run_db(resolve_trading_day, target_date)
+        if actual_date_str is None:
+            raise HTTPException(status_code=404, detail="交易日历中无对应交易日")
 
-        # 找到实际交易日（回溯最多10天）
-        actual_date_str = None
-        actual_date_no_dash = None
-        query_date = target_date
-        q_no_dash = date_no_dash
-        for back in range(10):
-            probe = ak.stock_board_industry_index_ths(symbol="银行", start_date=q_no_dash, end_date=q_no_dash)
-            if not probe.empty:
-                actual_date_no_dash = q_no_dash
-                actual_date_str = query_date.strftime("%Y-%m-%d")
-                break
-            query_date -= timedelta(days=1)
-            q_no_dash = query_date.strftime("%Y%m%d")
-        else:
-            raise HTTPException(status_code=404, detail="附近10天无交易日数据")
-
-        # 找前一交易日（计算涨跌幅基准）
-        prev_date_no_dash = None
-        prev_query = query_date - timedelta(days=1)
-        for back in range(1, 15):
-            p_no_dash = prev_query.strftime("%Y%m%d")
-            prev_probe = ak.stock_board_industry_index_ths(symbol="银行", start_date=p_no_dash, end_date=p_no_dash)
-            if not prev_probe.empty:
-                prev_date_no_dash = p_no_dash
-                break
-            prev_query -= timedelta(days=1)
-        else:
-            logger.warning("未找到前一交易日，涨跌幅可能不准")
+        # 缓存未命中或已过期时的拉取（在上游线程池中执行，同一交易日的并发请求只拉取一次）
+        async def load_industry():
+            cached, age = await run_db(get_cached_industry_with_age, actual_date_str)
+            if is_fresh("industry", actual_date_str, age):
+                return cached, None
+            return await run_upstream(fetch_industry_live, actual_date_str)
 
-        # 计算所有行业涨跌幅
-        sectors = []
-        for industry in industry_list:
-            try:
-                today_df = ak.stock_board_industry_index_ths(symbol=industry, start_date=actual_date_no_dash, end_date=actual_date_no_dash)
-                if today_df.empty or "收盘价" not in today_df.columns:
-                    continue
-                today_close = float(today_df["收盘价"].iloc[0])
-
-                if prev_date_no_dash:
-                    yesterday_df = ak.stock_board_industry_index_ths(symbol=industry, start_date=prev_date_no_dash, end_date=prev_date_no_dash)
-                    if not yesterday_df.empty and "收盘价" in yesterday_df.columns:
-                        yesterday_close = float(yesterday_df["收盘价"].iloc[0])
-                        change_percent = round((today_close - yesterday_close) / yesterday_close * 100, 2)
-                    else:
-                        change_percent = 0.0
-                else:
-                    change_percent = 0.0
+        # 1. 先查缓存（用实际交易日作为key）
+        cached_data, age = await run_db(get_cached_industry_with_age, actual_date_str)
+        if is_fresh("industry", actual_date_str, age):
+            logger.info(f"✅ 缓存命中: {actual_date_str}，共{len(cached_data)}条")
+            resp = {"code": 200, "message": "success", "data": cached_data, "data_source": "cache"}
+            if actual_date_str != target_date_str:
+                resp["note"] = f"请求日期{target_date_str}无数据，返回最近交易日{actual_date_str}"
+            return resp
 
-                sectors.append({
-                    "name": industry,
-                    "change_percent": change_percent,
-                    "date": actual_date_str  # 关键：保存时用实际交易日
-                })
-            except Exception as e:
-                logger.debug(f"行业 {industry} 获取失败: {e}")
-                continue
+        # 2. 当日数据过期或缺失：立即返回最近快照并在后台刷新
+        if actual_date_str == datetime.now().strftime("%Y-%m-%d"):
+            snapshot = cached_data or await run_db(get_latest_industry_snapshot, actual_date_str)
+            if snapshot:
+                refresh_in_background(("industry", actual_date_str), load_industry)
+                logger.info(f"⏳ 返回旧快照 {snapshot[0]['date']}，后台刷新 {actual_date_str}")
+                return {
+                    "code": 200,
+                    "message": "success",
+                    "data": snapshot,
+                    "data_source": "stale",
+                    "note": f"数据刷新中，暂返回 {snapshot[0]['date']} 的快照"
+                }
 
+        # 3. 缓存未命中，实时获取
+        logger.info(f"❌ 缓存未命中，实时拉取 {actual_date_str}")
+        try:
+            sectors, report = await live_fetch_flight.do(("industry", actual_date_str), load_industry)
+        except CircuitOpenError as e:
+            raise HTTPException(status_code=503, detail=f"上游数据源暂不可用：{e}")
         if not sectors:
+            if upstream_breaker.state != "closed":
+                raise HTTPException(status_code=503, detail="上游数据源暂不可用，请稍后重试")
             raise HTTPException(status_code=500, detail="所有行业数据获取失败")
 
-        # 排序
-        sectors.sort(key=lambda x: x["change_percent"], reverse=True)
-
-        # 保存缓存（用实际交易日作为key）
-        save_industry_data(sectors)
         logger.info(f"✅ 实时数据保存缓存成功: {actual_date_str}，共{len(sectors)}条")
 
         resp = {
@@ -569,6 +2872,9 @@ async def get_industry_data(date: str = None):
         }
         if actual_date_str != target_date_str:
             resp["note"] = f"请求日期{target_date_str}无数据，返回最近交易日{actual_date_str}"
+        if report is not None and report.failed_keys:
+            resp["failed_count"] = report.failed
+            response.headers["Cache-Control"] = DEGRADED_CACHE_CONTROL
 
         return resp
 
@@ -578,20 +2884,371 @@ async def get_industry_data(date: str = None):
         logger.error(f"行业数据异常: {e}")
         raise HTTPException(status_code=500, detail="服务器错误")
 
+def ndjson_line(obj: Dict) -> str:
+    return json.dumps(obj, ensure_ascii=False) + "\n"
+
+@app.get("/api/industry/stream")
+async def stream_industry_data(
+    date: str = Query(None, description="日期格式：YYYYMMDD，不提供则获取最新交易日数据")
+):
+    """
+    流式获取行业板块数据（NDJSON）
+
+    冷请求时每算完一个行业推送一行 {"type": "record", ...}，全部完成后推送
+    {"type": "summary", "data": [按涨跌幅排序的完整列表], ...}；失败时推送 {"type": "error", ...}。
+    record 行只用于提前渲染，以 summary 为准（命中缓存或合并到已在途的拉取时只有 summary）。
+    """
+    target_date = parse_date_param(date, "date") if date else datetime.now()
+    target_date_str = target_date.strftime('%Y-%m-%d')
+    if target_date.date() > datetime.now().date():
+        raise HTTPException(status_code=400, detail="不能查询未来日期")
+    actual_date_str = await run_db(resolve_trading_day, target_date)
+    if actual_date_str is None:
+        raise HTTPException(status_code=404, detail="交易日历中无对应交易日")
+
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+
+    def push_rows(rows: List[Dict]):
+        # 在上游抓取线程中调用，转交给事件循环
+        loop.call_soon_threadsafe(queue.put_nowait, rows)
+
+    async def load_industry():
+        cached, age = await run_db(get_cached_industry_with_age, actual_date_str)
+        if is_fresh("industry", actual_date_str, age):
+            return cached, None
+        return await run_upstream(fetch_industry_live, actual_date_str, push_rows)
+
+    async def produce() -> Tuple[List[Dict], str]:
+        try:
+            cached, age = await run_db(get_cached_industry_with_age, actual_date_str)
+            if is_fresh("industry", actual_date_str, age):
+                return cached, "cache"
+            # 与 /api/industry 共用合并 key：已在途时直接等待其结果
+            sectors, _ = await live_fetch_flight.do(("industry", actual_date_str), load_industry)
+            return sectors, "live"
+        finally:
+            queue.put_nowait(None)
+
+    async def frames():
+        task = asyncio.ensure_future(produce())
+        task.add_done_callback(_log_background_result)  # 客户端中途断开时仍记录失败
+        while (rows := await queue.get()) is not None:
+            for row in rows:
+                yield ndjson_line({"type": "record", "name": row["name"],
+                                   "change_percent": row["change_percent"], "date": row["date"]})
+        try:
+            sectors, source = await task
+        except Exception as e:
+            logger.error(f"流式行业数据失败: {e}")
+            yield ndjson_line({"type": "error", "message": f"上游数据源暂不可用：{e}"
+                               if isinstance(e, CircuitOpenError) else "服务器错误"})
+            return
+        if not sectors:
+            yield ndjson_line({"type": "error", "message": "所有行业数据获取失败"})
+            return
+        summary = {"type": "summary", "date": actual_date_str, "data": sectors, "data_source": source}
+        if actual_date_str != target_date_str:
+            summary["note"] = f"请求日期{target_date_str}无数据，返回最近交易日{actual_date_str}"
+        yield ndjson_line(summary)
+
+    return StreamingResponse(frames(), media_type="application/x-ndjson")
+
+# ==================== 区间查询 ====================
+RANGE_DEFAULT_PAGE_SIZE = 60   # 每页默认交易日数
+RANGE_MAX_PAGE_SIZE = 250      # 每页最多交易日数（约一年）
+
+def parse_date_param(value: str, field: str) -> datetime:
+    """解析 YYYYMMDD 查询参数，格式错误时返回400"""
+    try:
+        return datetime.strptime(value, "%Y%m%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{field} 日期格式错误，请使用YYYYMMDD（如20231009）")
+
+def paginate_trading_days(start: datetime, end: datetime, page: int, page_size: int) -> Tuple[List[str], int]:
+    """把 [start, end] 内的交易日分页，返回 (本页交易日, 总交易日数)"""
+    if start > end:
+        raise HTTPException(status_code=400, detail="start 不能晚于 end")
+    days = trading_days_between(start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d"))
+    offset = (page - 1) * page_size
+    return days[offset:offset + page_size], len(days)
+
+def fill_index_range(codes: List[str], days: List[str], refresh: Iterable[str] = ()) -> int:
+    """补齐区间内缺失的指数数据：每个指数一次增量同步 + 一次批量写入，多个指数并发（阻塞调用）
+
+    缺失、盘中写入（未定型）以及 refresh 中的交易日都重新计算；后两者的K线先从上游重新拉取覆盖。
+    """
+    settled = last_settled_trading_day()
+    wanted = [d for d in days if settled is None or d <= settled]
+    if not wanted:
+        return 0
+    refresh = set(refresh)
+    states = get_index_row_states(codes, wanted[0], wanted[-1])
+    gaps = {code: [d for d in wanted if d in refresh or not states.get((code, d), False)] for code in codes}
+    missing = [code for code in codes if gaps[code]]
+
+    def fill_one(code: str) -> int:
+        provisional = [d for d in gaps[code] if d in refresh or (code, d) in states]
+        index_history_store.sync(code, up_to=wanted[-1], refresh_from=provisional[0] if provisional else None)
+        first = gaps[code][0]
+        rows = build_index_rows(code, index_name(code), index_history_store.to_frame(code, first), first, wanted[-1])
+        return save_index_rows(rows)
+
+    if len(missing) <= 1:
+        return sum(fill_one(code) for code in missing)
+    filled, report = fan_out_fetch(missing, fill_one, label=f"指数区间补齐 {wanted[0]}~{wanted[-1]}")
+    if report.failed_keys:
+        # 成功的部分已入库；调用方需知道结果不完整
+        raise RuntimeError(f"{report.failed} 个指数补齐失败: {','.join(report.failed_keys[:10])}")
+    return sum(filled.values())
+
+def fill_industry_range(days: List[str], refresh: Iterable[str] = ()) -> int:
+    """补齐区间内不完整交易日的行业数据：每个行业一次区间调用覆盖所有缺口（阻塞调用）
+
+    某日只要有行业缺少定型后写入的数据（盘中快照或只保存了部分行业）即视为不完整；
+    应有的行业为当前行业列表中最早缓存日期不晚于该日的行业。refresh 中的交易日总是重新拉取。
+    """
+    settled = last_settled_trading_day()
+    wanted = [d for d in days if settled is None or d <= settled]
+    if not wanted:
+        return 0
+    refresh = set(refresh)
+    settled_names = get_settled_industry_names(wanted[0], wanted[-1])
+    first_dates = get_industry_first_dates()
+
+    def incomplete(day: str, sectors: Iterable[str]) -> bool:
+        names = settled_names.get(day)
+        return not names or any(name not in names and first_dates.get(name, "9999") <= day for name in sectors)
+
+    missing = [d for d in wanted if d in refresh or incomplete(d, first_dates)]
+    if not missing:
+        return 0
+    summary_df = call_upstream(ak.stock_board_industry_summary_ths)
+    if summary_df.empty:
+        raise ValueError("无法获取行业板块列表")
+    industry_list = summary_df["板块"].tolist()
+    # 已不在行业列表中的行业不再要求补齐
+    missing = [d for d in missing if d in refresh or incomplete(d, industry_list)]
+    if not missing:
+        return 0
+    matrix, report = load_industry_history(industry_list, missing[0], missing[-1])
+    if report.failed_keys:
+        raise RuntimeError(f"{report.failed} 个行业补齐失败: {','.join(report.failed_keys[:10])}")
+    return len(matrix)
+
+def range_response(data: List[Dict], days: List[str], total_days: int, page: int, page_size: int) -> Dict:
+    return {
+        "code": 200,
+        "message": "success",
+        "data": data,
+        "start": days[0] if days else None,
+        "end": days[-1] if days else None,
+        "page": page,
+        "page_size": page_size,
+        "total_days": total_days,
+        "has_more": page * page_size < total_days
+    }
+
+def degraded_range_response(response: Response, error: Optional[Exception], data: List[Dict], days: List[str],
+                            total_days: int, page: int, page_size: int) -> Dict:
+    """区间补齐失败时返回已有缓存：数据可能不完整，标记为不可缓存并附上说明"""
+    resp = range_response(data, days, total_days, page, page_size)
+    if error is not None:
+        response.headers["Cache-Control"] = DEGRADED_CACHE_CONTROL
+        resp["note"] = "部分数据补齐失败，已返回现有缓存，请稍后重试"
+    return resp
+
+@app.get("/api/index/range")
+async def get_index_range(
+    response: Response,
+    start: str = Query(..., description="开始日期 YYYYMMDD"),
+    end: str = Query(..., description="结束日期 YYYYMMDD"),
+    page: int = Query(1, ge=1, description="页码（按交易日分页）"),
+    page_size: int = Query(RANGE_DEFAULT_PAGE_SIZE, ge=1, le=RANGE_MAX_PAGE_SIZE, description="每页交易日数"),
+    codes: Optional[str] = Query(None, description="逗号分隔的已注册代码，不提供则返回主要指数")
+):
+    """获取指数在日期区间内的日线数据（补齐失败时返回已有缓存，并标记为不可缓存）"""
+    start_date = parse_date_param(start, "start")
+    end_date = parse_date_param(end, "end")
+    code_list = await run_db(resolve_index_codes, codes)
+    days, total_days = await run_db(paginate_trading_days, start_date, end_date, page, page_size)
+    if not days:
+        return range_response([], days, total_days, page, page_size)
+
+    error = None
+    try:
+        await live_fetch_flight.do(("index_range", days[0], days[-1], tuple(code_list)),
+                                   lambda: run_upstream(fill_index_range, code_list, days))
+    except Exception as e:
+        error = e
+        logger.error(f"补齐指数区间数据失败（返回已有缓存）: {e}")
+
+    data = await run_db(get_cached_index_range, code_list, days[0], days[-1])
+    return degraded_range_response(response, error, data, days, total_days, page, page_size)
+
+@app.get("/api/index/symbols")
+async def list_index_symbols():
+    """列出已启用的指数/ETF 代码"""
+    registry = await run_db(load_index_registry)
+    return {
+        "code": 200,
+        "message": "success",
+        "data": [{"code": code, **entry} for code, entry in registry.items()]
+    }
+
+@app.post("/api/index/symbols")
+async def add_index_symbol(
+    code: str = Query(..., description="上游代码，如 sh000016、sz399006"),
+    name: str = Query(..., description="显示名称"),
+    is_major: bool = Query(False, description="是否在默认指数列表中返回")
+):
+    """注册一个指数/ETF 代码（已存在则更新名称并重新启用），随后由定时刷新补齐历史"""
+    await run_db(register_index_symbol, code.strip(), name.strip(), is_major)
+    return {"code": 200, "message": "success", "data": {"code": code.strip(), "name": name.strip(), "is_major": is_major}}
+
+@app.delete("/api/index/symbols/{code}")
+async def remove_index_symbol(code: str):
+    """停用一个代码（已缓存的数据保留到过期清理）"""
+    if not await run_db(disable_index_symbol, code):
+        raise HTTPException(status_code=404, detail=f"未注册的代码: {code}")
+    return {"code": 200, "message": "success"}
+
+@app.get("/api/industry/range")
+async def get_industry_range(
+    response: Response,
+    start: str = Query(..., description="开始日期 YYYYMMDD"),
+    end: str = Query(..., description="结束日期 YYYYMMDD"),
+    page: int = Query(1, ge=1, description="页码（按交易日分页）"),
+    page_size: int = Query(RANGE_DEFAULT_PAGE_SIZE, ge=1, le=RANGE_MAX_PAGE_SIZE, description="每页交易日数")
+):
+    """获取所有行业板块在日期区间内的涨跌幅（补齐失败时返回已有缓存，并标记为不可缓存）"""
+    start_date = parse_date_param(start, "start")
+    end_date = parse_date_param(end, "end")
+    days, total_days = await run_db(paginate_trading_days, start_date, end_date, page, page_size)
+    if not days:
+        return range_response([], days, total_days, page, page_size)
+
+    error = None
+    try:
+        await live_fetch_flight.do(("industry_range", days[0], days[-1]),
+                                   lambda: run_upstream(fill_industry_range, days))
+    except Exception as e:
+        error = e
+        logger.error(f"补齐行业区间数据失败（返回已有缓存）: {e}")
+
+    data = await run_db(get_cached_industry_range, days[0], days[-1])
+    return degraded_range_response(response, error, data, days, total_days, page, page_size)
+
+@app.get("/api/scheduler/status")
+async def get_scheduler_status():
+    """定时刷新状态：最近一次运行的时间、耗时、结果及下次计划时间"""
+    if not leader_election.is_leader:
+        return {"code": 200, "message": "当前 worker 不是 leader，定时刷新由 leader 进程执行",
+                "data": {**refresh_scheduler.status, "worker": leader_election.stats()}}
+    return {"code": 200, "message": "success",
+            "data": {**refresh_scheduler.status, "analytics": analytics_refresher.status}}
+
+@app.post("/api/scheduler/run")
+async def run_scheduler_now():
+    """立即触发一次增量刷新"""
+    if not leader_election.is_leader:
+        raise HTTPException(status_code=409, detail="当前 worker 不是 leader，请稍后重试或直接请求 leader 进程")
+    refresh_scheduler.trigger()
+    return {"code": 200, "message": "已触发刷新", "data": refresh_scheduler.status}
+
+@app.get("/api/market/summary")
+async def get_market_summary(
+    month: Optional[str] = Query(None, description="月份 YYYYMM"),
+    year: Optional[str] = Query(None, description="年份 YYYY")
+):
+    """获取某月或某年每个交易日的市场概览（指数涨跌幅、最强/最弱行业、行业涨跌家数）"""
+    try:
+        if month:
+            first = datetime.strptime(month, "%Y%m")
+            last = (first.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+        elif year:
+            first = datetime.strptime(year, "%Y")
+            last = first.replace(month=12, day=31)
+        else:
+            raise HTTPException(status_code=400, detail="请提供 month（YYYYMM）或 year（YYYY）")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="日期格式错误，month 使用YYYYMM，year 使用YYYY")
+
+    data = await run_db(get_market_summaries, first.strftime("%Y-%m-%d"), last.strftime("%Y-%m-%d"))
+    return {"code": 200, "message": "success", "data": data}
+
+# ==================== 分析指标查询 ====================
+def parse_period_param(window: int) -> int:
+    if window not in ANALYTICS_PERIODS:
+        raise HTTPException(status_code=400, detail=f"window 只支持 {', '.join(map(str, ANALYTICS_PERIODS))}")
+    return window
+
+@app.get("/api/industry/top")
+async def get_industry_top_movers(
+    n: int = Query(10, ge=1, le=ANALYTICS_TOP_MAX, description="返回的行业数"),
+    window: int = Query(20, description="窗口（交易日）：5 / 20 / 60"),
+    date: Optional[str] = Query(None, description="日期 YYYYMMDD，不提供则为最新交易日"),
+    order: str = Query("desc", description="desc 为涨幅最大，asc 为跌幅最大")
+):
+    """区间涨幅前/后 n 名行业（读取预先物化的排名）"""
+    period = parse_period_param(window)
+    if order not in ("desc", "asc"):
+        raise HTTPException(status_code=400, detail="order 只支持 desc / asc")
+    day = parse_date_param(date, "date").strftime("%Y-%m-%d") if date else None
+    actual, data = await run_db(get_industry_top, period, n, day, order == "asc")
+    return {"code": 200, "message": "success", "date": actual, "window": period, "data": data}
+
+@app.get("/api/industry/rank_history")
+async def get_industry_rank_history_endpoint(
+    name: str = Query(..., description="行业名称"),
+    window: int = Query(20, description="窗口（交易日）：5 / 20 / 60"),
+    start: str = Query(..., description="开始日期 YYYYMMDD"),
+    end: str = Query(..., description="结束日期 YYYYMMDD")
+):
+    """某行业在日期区间内每天的区间收益率、波动率与排名"""
+    period = parse_period_param(window)
+    start_date = parse_date_param(start, "start").strftime("%Y-%m-%d")
+    end_date = parse_date_param(end, "end").strftime("%Y-%m-%d")
+    data = await run_db(get_industry_rank_history, name, period, start_date, end_date)
+    return {"code": 200, "message": "success", "window": period, "data": data}
+
+@app.get("/api/index/analytics")
+async def get_index_analytics_endpoint(
+    date: Optional[str] = Query(None, description="日期 YYYYMMDD，不提供则为最新交易日"),
+    codes: Optional[str] = Query(None, description="逗号分隔的已注册代码，不提供则返回主要指数")
+):
+    """指数在某交易日的 5/20/60 日区间收益率与波动率"""
+    code_list = await run_db(resolve_index_codes, codes)
+    target = parse_date_param(date, "date") if date else datetime.now()
+    day = await run_db(resolve_trading_day, target) or target.strftime("%Y-%m-%d")
+    data = await run_db(get_index_analytics, code_list, day)
+    return {"code": 200, "message": "success", "date": day, "data": data}
+
 if __name__ == "__main__":
     # 启动服务，监听在0.0.0.0:8000
     logger.info("AkShare API服务启动中...")
     logger.info("健康检查地址: http://localhost:8000/health")
     logger.info("指数数据地址: http://localhost:8000/api/index")
     logger.info("行业数据地址: http://localhost:8000/api/industry")
+    logger.info("区间数据地址: http://localhost:8000/api/index/range, http://localhost:8000/api/industry/range")
+    logger.info("流式行业数据: http://localhost:8000/api/industry/stream")
+    logger.info("指数代码注册表: http://localhost:8000/api/index/symbols")
+    logger.info("分析指标地址: http://localhost:8000/api/industry/top, http://localhost:8000/api/index/analytics")
+    logger.info("监控指标地址: http://localhost:8000/metrics")
+    logger.info("就绪探针地址: http://localhost:8000/ready")
 
 
     
+    import uvicorn
+
     try:
         uvicorn.run(
-            app, 
+            # 多 worker 需要以导入字符串启动，各 worker 进程独立导入本模块
+            "akshare_api_server:app" if API_WORKERS > 1 else app,
+            app_dir=os.path.dirname(os.path.abspath(__file__)),
             host="0.0.0.0", 
             port=8000,
+            workers=API_WORKERS,
             log_level="info",
             access_log=True,
             timeout_keep_alive=30
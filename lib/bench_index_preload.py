@@ -0,0 +1,93 @@
+"""
+指数预加载基准测试：逐行 iterrows + 单行提交 vs 向量化计算 + 单事务批量写入
+
+对 MAJOR_INDEXES 中每个指数各下载一次日线，分别用两种方式写入临时数据库，输出 rows/s。
+用法：
+    python bench_index_preload.py            # 使用上游真实数据
+    python bench_index_preload.py --days 3650
+"""
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+import akshare_api_server as server
+
+
+def legacy_preload_index(code: str, name: str, index_df: pd.DataFrame, start_str: str, end_str: str) -> int:
+    """旧实现：iterrows 逐行计算，每行一次 save_index_data（一次提交）"""
+    index_df = index_df.copy()
+    index_df["date"] = pd.to_datetime(index_df["date"])
+    mask = (index_df["date"] >= start_str) & (index_df["date"] <= end_str)
+    recent_data = index_df[mask]
+
+    for _, row in recent_data.iterrows():
+        current_idx = row.name
+        if current_idx > 0:
+            prev_close = float(index_df.iloc[current_idx - 1]["close"])
+            change_percent = round((row["close"] - prev_close) / prev_close * 100, 2)
+        else:
+            change_percent = round((row["close"] - row["open"]) / row["open"] * 100, 2)
+
+        server.save_index_data({
+            "code": code,
+            "name": name,
+            "date": row["date"].strftime('%Y-%m-%d'),
+            "open": float(row["open"]),
+            "close": float(row["close"]),
+            "high": float(row["high"]),
+            "low": float(row["low"]),
+            "volume": float(row["volume"]),
+            "change_percent": change_percent
+        })
+    return len(recent_data)
+
+
+def vectorized_preload_index(code: str, name: str, index_df: pd.DataFrame, start_str: str, end_str: str) -> int:
+    """新实现：整列计算涨跌幅，一次事务批量写入"""
+    rows = server.build_index_rows(code, name, index_df, start_str, end_str)
+    return server.save_index_rows(rows)
+
+
+def run(label: str, preload_fn, frames, start_str: str, end_str: str):
+    """在全新的临时数据库上跑一遍所有指数，返回 (行数, 秒)"""
+    with tempfile.TemporaryDirectory() as tmp:
+        server.DB_PATH = os.path.join(tmp, "bench.db")
+        server._writer_conn = None
+        server._thread_local.__dict__.clear()
+        server.init_database()
+
+        total = 0
+        start = time.perf_counter()
+        for code, index_df in frames.items():
+            total += preload_fn(code, server.MAJOR_INDEXES[code], index_df, start_str, end_str)
+        elapsed = time.perf_counter() - start
+
+        server._writer_conn.close()
+        server._writer_conn = None
+    print(f"{label:<12} {total:>7} 行  {elapsed:8.3f}s  {total / elapsed:12.0f} rows/s")
+    return total, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="指数预加载基准测试")
+    parser.add_argument("--days", type=int, default=server.DATA_RETENTION_DAYS, help="预加载窗口（天）")
+    args = parser.parse_args()
+
+    end_str = datetime.now().strftime("%Y-%m-%d")
+    start_str = (datetime.now() - timedelta(days=args.days)).strftime("%Y-%m-%d")
+
+    print(f"下载 {len(server.MAJOR_INDEXES)} 个指数日线...")
+    frames = {code: server.ak.stock_zh_index_daily(symbol=code) for code in server.MAJOR_INDEXES}
+
+    print(f"窗口 {start_str} ~ {end_str}")
+    _, legacy_s = run("iterrows", legacy_preload_index, frames, start_str, end_str)
+    _, vector_s = run("vectorized", vectorized_preload_index, frames, start_str, end_str)
+    print(f"加速比: {legacy_s / vector_s:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""
+离线基准测试：用 fake_akshare 替身驱动完整的 FastAPI 服务，无需访问网络
+
+场景：
+    cold-index / warm-index        各交易日首次请求 /api/index，与之后的重复请求
+    cold-industry / warm-industry  同上，/api/industry（历史日期走逐行业区间拉取）
+    preload                        在空库上执行一次 preload_historical_data
+    concurrent                     多个客户端并发请求已缓存的混合URL
+
+每个场景输出 p50/p99 延迟、吞吐量与各 akshare 接口的调用次数。
+用法：
+    python bench_offline.py
+    python bench_offline.py --latency 0.2 --failure-rate 0.05 --industries 60
+    python bench_offline.py --save baseline.json
+    python bench_offline.py --baseline baseline.json   # p99 / 吞吐退化超过阈值时返回非零退出码
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+
+import fake_akshare
+from load_test import percentile
+
+
+def load_server(args):
+    """安装替身后导入服务端模块，并指向临时数据库"""
+    fake = fake_akshare.FakeAkshare(latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate,
+                                    seed=args.seed, industries=args.industries,
+                                    recordings=args.recordings).install()
+    import akshare_api_server as server
+    import logging
+    server.logger.setLevel(logging.WARNING)
+    server.DB_PATH = os.path.join(args.workdir, "bench.db")
+    # 基准测试自行控制预加载，不启动 leader 的后台刷新任务
+    server.start_leader_jobs = lambda: None
+    if args.fetch_rate:
+        server.upstream_limiter.rate = args.fetch_rate
+    return fake, server
+
+
+def start_app(server, port: int):
+    import uvicorn
+    config = uvicorn.Config(server.app, host="127.0.0.1", port=port, log_level="warning", access_log=False)
+    app_server = uvicorn.Server(config)
+    thread = threading.Thread(target=app_server.run, daemon=True)
+    thread.start()
+    while not app_server.started:
+        time.sleep(0.05)
+    # 等待后台预热（建表、交易日历）完成
+    while True:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/ready", timeout=5):
+                break
+        except urllib.error.HTTPError:
+            time.sleep(0.05)
+    return app_server, thread
+
+
+def timed_get(url: str, timeout: float) -> float:
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as resp:
+            resp.read()
+    except urllib.error.HTTPError as e:
+        e.read()  # 5xx 也计入延迟（如注入失败导致的503），便于观察降级路径
+    return (time.perf_counter() - start) * 1000
+
+
+def run_scenario(name: str, fake, fn: Callable[[], List[float]]) -> Dict:
+    """执行一个场景，返回延迟统计、吞吐量和上游调用次数增量"""
+    before = fake.snapshot()
+    start = time.perf_counter()
+    latencies = fn()
+    elapsed = time.perf_counter() - start
+    after = fake.snapshot()
+    calls = {k: after[k] - before.get(k, 0) for k in after if after[k] != before.get(k, 0)}
+    result = {
+        "scenario": name,
+        "n": len(latencies),
+        "p50_ms": round(percentile(latencies, 50), 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99), 2) if latencies else None,
+        "max_ms": round(max(latencies), 2) if latencies else None,
+        "elapsed_s": round(elapsed, 3),
+        "throughput": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "upstream_calls": calls,
+    }
+    print(f"{name:<15} n={result['n']:<5} p50={result['p50_ms']}ms p99={result['p99_ms']}ms "
+          f"吞吐={result['throughput']}/s 上游调用={sum(calls.values())} {calls}")
+    return result
+
+
+def concurrent_get(urls: List[str], concurrency: int, timeout: float) -> List[float]:
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(lambda u: timed_get(u, timeout), urls))
+
+
+def compare(results: List[Dict], baseline_path: str, tolerance: float) -> bool:
+    """与基线比较：p99 变慢或吞吐下降超过 tolerance 倍即视为退化"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {r["scenario"]: r for r in json.load(f)["results"]}
+    ok = True
+    print(f"\n== 与基线比较（阈值 {tolerance}x）==")
+    for r in results:
+        base = baseline.get(r["scenario"])
+        if not base or not base.get("p99_ms") or not r.get("p99_ms"):
+            continue
+        p99_ratio = r["p99_ms"] / base["p99_ms"]
+        tput_ratio = base["throughput"] / r["throughput"] if r["throughput"] else float("inf")
+        regressed = p99_ratio > tolerance or tput_ratio > tolerance
+        ok = ok and not regressed
+        print(f"{r['scenario']:<15} p99 {base['p99_ms']}ms -> {r['p99_ms']}ms ({p99_ratio:.2f}x)  "
+              f"吞吐 {base['throughput']} -> {r['throughput']}/s {'退化' if regressed else ''}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线基准测试（伪 akshare）")
+    parser.add_argument("--latency", type=float, default=0.05, help="伪上游平均延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.5, help="延迟抖动比例")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="伪上游失败率")
+    parser.add_argument("--industries", type=int, default=30, help="伪行业数量")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--recordings", default=None, help="录制数据目录（CSV）")
+    parser.add_argument("--fetch-rate", type=float, default=None, help="覆盖上游令牌桶速率（每秒）")
+    parser.add_argument("--cold-days", type=int, default=3, help="冷请求的交易日数")
+    parser.add_argument("--warm-requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--concurrent-requests", type=int, default=2000)
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--save", default=None, help="把结果保存为 JSON（可作为基线）")
+    parser.add_argument("--baseline", default=None, help="基线 JSON 文件")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="退化阈值（倍）")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        args.workdir = workdir
+        fake, server = load_server(args)
+        app_server, thread = start_app(server, args.port)
+        base = f"http://127.0.0.1:{args.port}"
+        results = []
+        try:
+            # 取最近已收盘的若干交易日（不含最新一天，避免当日刷新逻辑干扰）
+            settled = server.last_settled_trading_day()
+            start = (datetime.now() - timedelta(days=args.cold_days * 3 + 10)).strftime("%Y-%m-%d")
+            days = server.trading_days_between(start, settled)[-args.cold_days - 1:-1]
+            index_urls = [f"{base}/api/index?date={d.replace('-', '')}" for d in days]
+            industry_urls = [f"{base}/api/industry?date={d.replace('-', '')}" for d in days]
+
+            results.append(run_scenario("cold-index", fake,
+                                        lambda: [timed_get(u, args.timeout) for u in index_urls]))
+            results.append(run_scenario("warm-index", fake, lambda: concurrent_get(
+                index_urls * (args.warm_requests // len(index_urls)), args.concurrency, args.timeout)))
+            results.append(run_scenario("cold-industry", fake,
+                                        lambda: [timed_get(u, args.timeout) for u in industry_urls]))
+            results.append(run_scenario("warm-industry", fake, lambda: concurrent_get(
+                industry_urls * (args.warm_requests // len(industry_urls)), args.concurrency, args.timeout)))
+
+            mixed = [f"{base}/health"] + index_urls + industry_urls
+            results.append(run_scenario("concurrent", fake, lambda: concurrent_get(
+                (mixed * (args.concurrent_requests // len(mixed) + 1))[:args.concurrent_requests],
+                args.concurrency, args.timeout)))
+
+            # 预加载：清空数据表后整体补齐，单次耗时即为一个样本
+            def preload() -> List[float]:
+                with server.write_transaction() as conn:
+                    for table in ("index_data", "industry_data", "index_history", "market_summary", "response_cache"):
+                        conn.execute(f"DELETE FROM {table}")
+                server.index_history_store = server.IndexHistoryStore()
+                start = time.perf_counter()
+                outcome = server.preload_historical_data()
+                ms = (time.perf_counter() - start) * 1000
+                rows = outcome["index_rows"] + outcome["industry_rows"]
+                print(f"{'':<15} 预加载 {rows} 行，{rows / (ms / 1000):.0f} rows/s")
+                return [ms]
+            results.append(run_scenario("preload", fake, preload))
+        finally:
+            app_server.should_exit = True
+            thread.join(timeout=10)
+            server._writer_conn.close()
+
+    payload = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("workdir", "save", "baseline")},
+        "results": results,
+    }
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(payload, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已保存到 {args.save}")
+    if args.baseline and not compare(results, args.baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""
+离线 akshare 替身：返回录制的或确定性合成的 DataFrame，可配置延迟与失败率
+
+只实现 akshare_api_server.py 用到的接口。必须在导入服务端模块之前安装：
+    import fake_akshare
+    fake = fake_akshare.FakeAkshare(latency=0.05, failure_rate=0.02).install()
+    import akshare_api_server as server
+
+录制数据：recordings 目录下的 <函数名>.csv 或 <函数名>__<symbol>.csv 优先于合成数据。
+"""
+import os
+import random
+import sys
+import threading
+import time
+import types
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+HISTORY_DAYS = 3 * 365          # 合成日线覆盖的自然日数
+CALENDAR_FUTURE_DAYS = 60       # 交易日历向未来多生成的天数（与真实接口一致，包含未来交易日）
+DEFAULT_INDEXES = {"sh000001": 3000.0, "sz399001": 10000.0, "sz399006": 2000.0, "sh000300": 3800.0}
+
+
+class FakeUpstreamError(Exception):
+    """按失败率注入的上游错误"""
+
+
+class FakeAkshare(types.ModuleType):
+    """伪 akshare 模块：所有数据由 (函数, symbol, seed) 确定，调用次数与耗时可统计"""
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.5, failure_rate: float = 0.0,
+                 seed: int = 42, industries: int = 30, recordings: Optional[str] = None):
+        super().__init__("akshare")
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.seed = seed
+        self.industries = [f"行业{i:03d}" for i in range(industries)]
+        self.recordings = recordings
+        self.calls: Counter = Counter()
+        self.failures: Counter = Counter()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def install(self) -> "FakeAkshare":
+        sys.modules["akshare"] = self
+        return self
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.calls)
+
+    # ---------- 公共行为：计数、延迟、故障注入、录制数据 ----------
+    def _enter(self, func: str, symbol: Optional[str] = None) -> Optional[pd.DataFrame]:
+        with self._lock:
+            self.calls[func] += 1
+            delay = self.latency * (1 + self.jitter * (2 * self._rng.random() - 1))
+            fail = self._rng.random() < self.failure_rate
+        time.sleep(max(0.0, delay))
+        if fail:
+            with self._lock:
+                self.failures[func] += 1
+            raise FakeUpstreamError(f"{func}({symbol}) 注入失败")
+        if self.recordings:
+            for name in ([f"{func}__{symbol}.csv"] if symbol else []) + [f"{func}.csv"]:
+                path = os.path.join(self.recordings, name)
+                if os.path.exists(path):
+                    return pd.read_csv(path)
+        return None
+
+    @staticmethod
+    def _trading_days(start: datetime, end: datetime) -> List[datetime]:
+        days = pd.bdate_range(start.date(), end.date())
+        return [d.to_pydatetime() for d in days]
+
+    def _series(self, key: str, base: float, days: List[datetime]) -> pd.DataFrame:
+        """按 key 确定性生成随机游走日线（同一 key 每次结果相同，便于增量拉取拼接）"""
+        rng = random.Random(f"{self.seed}:{key}")
+        all_days = self._trading_days(datetime.now() - timedelta(days=HISTORY_DAYS), datetime.now())
+        close = base
+        rows = []
+        wanted = {d.date() for d in days}
+        for d in all_days:
+            open_ = close * (1 + rng.gauss(0, 0.004))
+            close = open_ * (1 + rng.gauss(0, 0.012))
+            high = max(open_, close) * (1 + abs(rng.gauss(0, 0.004)))
+            low = min(open_, close) * (1 - abs(rng.gauss(0, 0.004)))
+            volume = rng.randint(10 ** 8, 5 * 10 ** 8)
+            if d.date() in wanted:
+                rows.append((d, open_, high, low, close, volume))
+        return pd.DataFrame(rows, columns=["date", "open", "high", "low", "close", "volume"])
+
+    @staticmethod
+    def _parse(value: Optional[str], default: datetime) -> datetime:
+        return datetime.strptime(value, "%Y%m%d") if value else default
+
+    # ---------- akshare 接口 ----------
+    def tool_trade_date_hist_sina(self) -> pd.DataFrame:
+        recorded = self._enter("tool_trade_date_hist_sina")
+        if recorded is not None:
+            return recorded
+        days = self._trading_days(datetime.now() - timedelta(days=HISTORY_DAYS),
+                                  datetime.now() + timedelta(days=CALENDAR_FUTURE_DAYS))
+        return pd.DataFrame({"trade_date": [d.date() for d in days]})
+
+    def stock_zh_index_daily(self, symbol: str) -> pd.DataFrame:
+        recorded = self._enter("stock_zh_index_daily", symbol)
+        if recorded is not None:
+            return recorded
+        days = self._trading_days(datetime.now() - timedelta(days=HISTORY_DAYS), datetime.now())
+        return self._series(symbol, DEFAULT_INDEXES.get(symbol, 1000.0), days)
+
+    def stock_zh_index_daily_em(self, symbol: str, start_date: str = None, end_date: str = None) -> pd.DataFrame:
+        recorded = self._enter("stock_zh_index_daily_em", symbol)
+        if recorded is not None:
+            return recorded
+        days = self._trading_days(self._parse(start_date, datetime.now() - timedelta(days=HISTORY_DAYS)),
+                                  self._parse(end_date, datetime.now()))
+        return self._series(symbol, DEFAULT_INDEXES.get(symbol, 1000.0), days)
+
+    def stock_board_industry_summary_ths(self) -> pd.DataFrame:
+        recorded = self._enter("stock_board_industry_summary_ths")
+        if recorded is not None:
+            return recorded
+        rng = random.Random(f"{self.seed}:summary:{datetime.now().date()}")
+        return pd.DataFrame({
+            "板块": self.industries,
+            "涨跌幅": [round(rng.gauss(0, 1.5), 2) for _ in self.industries],
+        })
+
+    def stock_sector_spot(self, indicator: str = "新浪行业") -> pd.DataFrame:
+        recorded = self._enter("stock_sector_spot")
+        if recorded is not None:
+            return recorded
+        rng = random.Random(f"{self.seed}:spot:{datetime.now().date()}")
+        return pd.DataFrame({
+            "板块": self.industries,
+            "涨跌幅": [round(rng.gauss(0, 1.5), 2) for _ in self.industries],
+        })
+
+    def stock_board_industry_index_ths(self, symbol: str, start_date: str = None, end_date: str = None) -> pd.DataFrame:
+        recorded = self._enter("stock_board_industry_index_ths", symbol)
+        if recorded is not None:
+            return recorded
+        days = self._trading_days(self._parse(start_date, datetime.now() - timedelta(days=HISTORY_DAYS)),
+                                  self._parse(end_date, datetime.now()))
+        df = self._series(f"industry:{symbol}", 1000.0, days)
+        return pd.DataFrame({
+            "日期": df["date"].dt.strftime("%Y-%m-%d"),
+            "开盘价": df["open"],
+            "最高价": df["high"],
+            "最低价": df["low"],
+            "收盘价": df["close"],
+            "成交量": df["volume"],
+        })
@@ -0,0 +1,102 @@
+"""
+缓存命中路径压测：验证冷请求拉取上游期间，缓存命中请求与 /health 的延迟保持平稳
+
+用法（先启动 akshare_api_server.py）：
+    python load_test.py --hit-date 20240102 --cold-date 20230601
+
+--hit-date 应为已缓存的交易日，--cold-date 应为尚未缓存的交易日（会触发完整的上游拉取）。
+"""
+import argparse
+import statistics
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def timed_get(url: str, timeout: float) -> float:
+    """请求一次并返回耗时（毫秒）"""
+    start = time.perf_counter()
+    with urllib.request.urlopen(url, timeout=timeout) as resp:
+        resp.read()
+    return (time.perf_counter() - start) * 1000
+
+
+def percentile(values, pct: float) -> float:
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def run_round(urls, requests_per_url: int, concurrency: int, timeout: float):
+    """并发压测一轮，返回 url -> 延迟列表"""
+    jobs = [url for url in urls for _ in range(requests_per_url)]
+    latencies = {url: [] for url in urls}
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for url, ms in zip(jobs, pool.map(lambda u: timed_get(u, timeout), jobs)):
+            latencies[url].append(ms)
+    return latencies
+
+
+def summarize(title: str, latencies):
+    print(f"\n== {title} ==")
+    for url, values in latencies.items():
+        print(f"{url:<60} n={len(values):<5} p50={statistics.median(values):8.1f}ms "
+              f"p99={percentile(values, 99):8.1f}ms max={max(values):8.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="缓存命中延迟压测")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--hit-date", required=True, help="已缓存的日期 YYYYMMDD")
+    parser.add_argument("--cold-date", required=True, help="未缓存的日期 YYYYMMDD")
+    parser.add_argument("--requests", type=int, default=200, help="每个URL的请求数")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    args = parser.parse_args()
+
+    hit_urls = [
+        f"{args.base_url}/health",
+        f"{args.base_url}/api/index?date={args.hit_date}",
+        f"{args.base_url}/api/industry?date={args.hit_date}",
+    ]
+    cold_url = f"{args.base_url}/api/industry?date={args.cold_date}"
+
+    # 预热：确保命中日期已在缓存中
+    for url in hit_urls:
+        timed_get(url, timeout=600)
+
+    baseline = run_round(hit_urls, args.requests, args.concurrency, args.timeout)
+    summarize("基线（无冷请求）", baseline)
+
+    cold_result = {}
+
+    def cold_fetch():
+        try:
+            cold_result["ms"] = timed_get(cold_url, timeout=600)
+        except Exception as e:
+            cold_result["error"] = str(e)
+
+    cold_thread = threading.Thread(target=cold_fetch, daemon=True)
+    cold_thread.start()
+    time.sleep(0.5)  # 让冷请求先进入上游拉取阶段
+
+    during = run_round(hit_urls, args.requests, args.concurrency, args.timeout)
+    in_flight = cold_thread.is_alive()
+    summarize(f"冷请求进行中（结束时冷请求仍在途: {in_flight}）", during)
+
+    print("\n== p99 对比 ==")
+    for url in hit_urls:
+        before = percentile(baseline[url], 99)
+        after = percentile(during[url], 99)
+        print(f"{url:<60} {before:8.1f}ms -> {after:8.1f}ms ({after / before:5.2f}x)")
+
+    cold_thread.join()
+    if "error" in cold_result:
+        print(f"\n冷请求失败: {cold_result['error']}")
+    else:
+        print(f"\n冷请求耗时: {cold_result['ms'] / 1000:.1f}s")
+
+
+if __name__ == "__main__":
+    main()